@@ -1,23 +1,58 @@
 import os
 
 from flask import Flask
-from flask_restful import Api
-from flask_cors import CORS
-
-from resources.user import User, UserList, UserRegister, UserLogin, UserLogout, Me, PurgeTestUsers, GenerateUsers
-
-if not 'FRONT_END' in os.environ:
-    os.environ['FRONT_END'] = 'http://127.0.0.1:3000'
-
-app = Flask(__name__)
-cors = CORS(app, supports_credentials=True, origins=['http://localhost:3000', 'http://127.0.0.1:3000'])
-api = Api(app)
-
-api.add_resource(Me, '/me')
-api.add_resource(User, '/user/<string:user_id>')
-api.add_resource(UserList, '/users')
-api.add_resource(UserLogin, '/login')
-api.add_resource(UserLogout, '/logout')
-api.add_resource(UserRegister, '/register')
-api.add_resource(PurgeTestUsers, '/purge')
-api.add_resource(GenerateUsers, '/spam')
+
+CORS_ORIGINS = ['http://localhost:3000', 'http://127.0.0.1:3000']
+
+
+def create_app(config='config.DevelopmentConfig', warm_up=False):
+    """
+    Builds a configured app. Resources, models and the database layer are only imported here,
+    so importing this module (e.g. in a preforking master) is cheap.
+    """
+    from flask_cors import CORS
+    from flask_restful import Api
+
+    import metrics
+    import outbox
+    import sessions
+    from bootstrap import init_db_command, warm_up as warm_up_app
+    from db import db
+    from resources.admin import PoolStats, OutboxStats
+    from resources.user import User, UserList, UserRegister, UserLogin, UserLogout, Me, PurgeTestUsers,\
+        GenerateUsers, UserBulk, UserBatch, UserSearch, UserChanges, UserAvailability
+
+    if not 'FRONT_END' in os.environ:
+        os.environ['FRONT_END'] = 'http://127.0.0.1:3000'
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    cors = CORS(app, supports_credentials=True, origins=CORS_ORIGINS)
+    api = Api(app)
+    metrics.init_app(app)
+    outbox.init_app(app)
+
+    api.add_resource(Me, '/me')
+    api.add_resource(User, '/user/<string:user_id>')
+    api.add_resource(UserList, '/users')
+    api.add_resource(UserBulk, '/users/bulk')
+    api.add_resource(UserBatch, '/users/batch')
+    api.add_resource(UserSearch, '/users/search')
+    api.add_resource(UserChanges, '/users/changes')
+    api.add_resource(UserLogin, '/login')
+    api.add_resource(UserLogout, '/logout')
+    api.add_resource(UserRegister, '/register')
+    api.add_resource(UserAvailability, '/register/available')
+    api.add_resource(PurgeTestUsers, '/purge')
+    api.add_resource(GenerateUsers, '/spam')
+    api.add_resource(PoolStats, '/admin/pool')
+    api.add_resource(OutboxStats, '/admin/outbox')
+
+    sessions.init_app(app)
+    db.init_app(app)
+    app.cli.add_command(init_db_command)
+
+    if warm_up:
+        warm_up_app(app)
+
+    return app
@@ -0,0 +1,503 @@
+"""
+Async serving mode: the app under uvicorn, with the I/O-bound read endpoints on an event loop.
+
+    python run.py asgi
+
+Every route of the Flask app keeps working, as the whole app is mounted behind the native
+endpoints. GET /user/<id>, GET /me, GET /users and POST /users/batch are served on the loop with
+an asyncio database driver (asyncpg for PostgreSQL, aiosqlite for SQLite) and httpx for the token
+service, overlapping the waits which don't depend on each other; GET /users e.g. looks up the
+caller's role, the list version and the users at the same time when the token is verified locally.
+Anything a native endpoint doesn't answer exactly like Flask would (streamed lists, malformed
+arguments, sessions of Flask-Session backends or due to be renewed) is passed on to the Flask app,
+so responses are the same.
+
+Tuned through environment variables, on top of the app's own:
+    BIND                        address to listen on (0.0.0.0:5000)
+    WEB_WORKERS                 worker processes (CPU cores)
+    WEB_KEEPALIVE               seconds to keep idle client connections open (5)
+    WARM_UP                     open pool connections and fill caches before a worker takes traffic (1)
+    METRICS_DIR                 directory through which workers share their metrics (see metrics.py)
+    ASYNC_DB_POOL_SIZE          connections of the async engine per worker (20)
+    ASYNC_DB_MAX_OVERFLOW       extra connections opened under load (10)
+    ASYNC_UPSTREAM_CONCURRENCY  calls per worker and service in flight at once (100)
+
+Blocking work (password hashing, writes, streaming) stays on the Flask side, which runs in a
+thread pool of each worker.
+"""
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import random
+import time
+from datetime import datetime
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import select, tuple_
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_etags, quote_etag
+
+from app import create_app, CORS_ORIGINS
+from bootstrap import warm_up
+from errors import RetryLater
+from metrics import request_duration, profile_cache_requests, upstream_duration, upstream_rejections, shared_metrics
+from models.user import UserModel
+from outbox import dispatcher
+from resources.user import UserList, UserBatch
+from sessions import DatabaseStore, StoreSessionInterface
+from tokens import get_verifier, InvalidToken
+from upstream import token_service, RETRY_STATUSES, UpstreamUnavailable
+from utils import encode_cursor, decode_cursor, parse_datetime, etag_header
+
+ASYNC_DRIVERS = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}
+
+
+class Fallback(Exception):
+    """ Raised by native endpoints for requests the Flask app has to serve """
+
+
+class Abort(Exception):
+    """ Ends a native endpoint with the given JSON body and status """
+    def __init__(self, body, status):
+        super().__init__(body)
+        self.body = body
+        self.status = status
+
+
+def async_url(url):
+    """ The same database with the asyncio driver of its dialect """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No asyncio driver for {backend} databases')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+class AsyncUpstream:
+    """
+    httpx counterpart of an UpstreamClient, sharing its settings, metrics and circuit breaker.
+    The bulkhead is a semaphore of ASYNC_UPSTREAM_CONCURRENCY, as waiting calls no longer tie up threads.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.http = None
+        self.bulkhead = None
+
+    def start(self):
+        client = self.client
+        concurrency = int(os.environ.get('ASYNC_UPSTREAM_CONCURRENCY', 100))
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(client.setting('READ_TIMEOUT', 5.0), connect=client.setting('CONNECT_TIMEOUT', 1.0)),
+            limits=httpx.Limits(max_connections=concurrency,
+                                max_keepalive_connections=client.setting('POOL_SIZE', 10, int)),
+        )
+        self.bulkhead = asyncio.Semaphore(concurrency)
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def get(self, path, **kwargs):
+        client = self.client
+        retries = client.setting('RETRIES', 2, int)
+        backoff = client.setting('BACKOFF', 0.1)
+
+        for attempt in range(retries + 1):
+            resp = await self._attempt('GET', f'{client.base_url}{path}', kwargs)
+            if resp is None:
+                if attempt == retries:
+                    raise UpstreamUnavailable(client.name)
+            elif resp.status_code not in RETRY_STATUSES or attempt == retries:
+                return resp
+            await asyncio.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+    async def _attempt(self, method, url, kwargs):
+        """ Makes a single call through the bulkhead and the breaker, returns None if it didn't connect """
+        client = self.client
+        try:
+            await asyncio.wait_for(self.bulkhead.acquire(), client.setting('BULKHEAD_TIMEOUT', 0.05))
+        except asyncio.TimeoutError:
+            upstream_rejections.inc(upstream=client.name, reason='bulkhead')
+            raise UpstreamUnavailable(client.name, retry_after=1)
+        try:
+            if not client.breaker.allow():
+                upstream_rejections.inc(upstream=client.name, reason='circuit_open')
+                raise UpstreamUnavailable(client.name, retry_after=client.breaker.retry_after())
+
+            resp = None
+            start = time.perf_counter()
+            try:
+                resp = await self.http.request(method, url, **kwargs)
+            except httpx.TransportError:
+                pass
+            finally:
+                elapsed = time.perf_counter() - start
+                client.breaker.record(elapsed, resp is None or resp.status_code >= 500)
+                failed = resp is None or resp.status_code in RETRY_STATUSES
+                upstream_duration.observe(elapsed, upstream=client.name, method=method,
+                                          outcome='error' if failed else 'ok')
+            return resp
+        finally:
+            self.bulkhead.release()
+
+
+class NativeEndpoint:
+    """
+    ASGI app of a native endpoint, which turns Abort and RetryLater into responses like
+    flask-restful does and hands requests raising Fallback over to the Flask app.
+    """
+    def __init__(self, server, handler, rule):
+        self.server = server
+        self.handler = handler
+        self.rule = rule
+
+    async def __call__(self, scope, receive, send):
+        start = time.perf_counter()
+        request = Request(scope, receive)
+        try:
+            response = await self.handler(request)
+        except Fallback:
+            body = await request.body()
+            return await self.server.flask(scope, replay(body), send)
+        except Abort as e:
+            response = JSONResponse(e.body, e.status)
+        except RetryLater as e:
+            response = JSONResponse({'message': e.description}, e.code, headers={
+                name: value for name, value in e.get_headers() if name != 'Content-Type'
+            })
+
+        origin = request.headers.get('origin')
+        if origin in CORS_ORIGINS:
+            response.headers.update({
+                'Access-Control-Allow-Origin': origin,
+                'Access-Control-Allow-Credentials': 'true',
+                'Vary': 'Origin',
+            })
+        await response(scope, receive, send)
+        request_duration.observe(time.perf_counter() - start, method=request.method, endpoint=self.rule,
+                                 status=response.status_code)
+
+
+def replay(body):
+    """ `receive` for an app which is handed a request whose body was already read """
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {'type': 'http.disconnect'}
+        sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    return receive
+
+
+def is_string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def etag_matches(request, etag):
+    return etag is not None and etag in parse_etags(request.headers.get('if-none-match'))
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers={'ETag': quote_etag(etag)})
+
+
+class AsyncServer:
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.flask = WSGIMiddleware(flask_app)
+        self.engine = None
+        self.session_engine = None
+        self.token_service = AsyncUpstream(token_service)
+        self._loads = {}
+
+    def routes(self):
+        return [
+            Route('/me', NativeEndpoint(self, self.me, '/me'), methods=['GET']),
+            Route('/user/{user_id}', NativeEndpoint(self, self.user, '/user/<string:user_id>'), methods=['GET']),
+            Route('/users', NativeEndpoint(self, self.users, '/users'), methods=['GET']),
+            Route('/users/batch', NativeEndpoint(self, self.user_batch, '/users/batch'), methods=['POST']),
+            Mount('/', app=self.flask),
+        ]
+
+    @contextlib.asynccontextmanager
+    async def lifespan(self, app):
+        await self.startup()
+        try:
+            yield
+        finally:
+            await self.shutdown()
+
+    async def startup(self):
+        url = async_url(self.app.config['SQLALCHEMY_DATABASE_URI'])
+        pool = {} if url.get_backend_name() == 'sqlite' else {
+            'pool_size': int(os.environ.get('ASYNC_DB_POOL_SIZE', 20)),
+            'max_overflow': int(os.environ.get('ASYNC_DB_MAX_OVERFLOW', 10)),
+        }
+        self.engine = create_async_engine(url, pool_pre_ping=True, **pool)
+
+        store = getattr(self.app.session_interface, 'store', None)
+        if isinstance(store, DatabaseStore):
+            self.session_engine = create_async_engine(async_url(store.uri)) if store.uri else self.engine
+
+        self.token_service.start()
+        # revocations are synced whether or not the worker warms up
+        get_verifier().start(self.app)
+        if self.app.config.get('OUTBOX_DISPATCH', True):
+            dispatcher.ensure_running(self.app)
+        if os.environ.get('WARM_UP', '1') == '1':
+            await run_in_threadpool(warm_up, self.app)
+
+    async def shutdown(self):
+        await self.token_service.close()
+        if self.session_engine is not None and self.session_engine is not self.engine:
+            await self.session_engine.dispose()
+        await self.engine.dispose()
+
+    async def fetch(self, statement, engine=None):
+        async with (engine or self.engine).connect() as connection:
+            return (await connection.execute(statement)).all()
+
+    async def coalesce(self, key, load):
+        """ Runs `load` once for concurrent callers asking for the same key """
+        task = self._loads.get(key)
+        if task is None:
+            task = self._loads[key] = asyncio.ensure_future(load())
+            task.add_done_callback(lambda _: self._loads.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def session(self, request):
+        """ Data of the caller's session, or an empty dict """
+        interface = self.app.session_interface
+        if not isinstance(interface, StoreSessionInterface):
+            raise Fallback
+
+        sid = request.cookies.get(self.app.config['SESSION_COOKIE_NAME'])
+        if not sid:
+            return {}
+        if self.session_engine is not None:
+            table = DatabaseStore.table
+            rows = await self.fetch(
+                select([table.c.data, table.c.expires_at])
+                .where(table.c.id == sid)
+                .where(table.c.expires_at > datetime.utcnow()),
+                self.session_engine,
+            )
+            stored = rows[0] if rows else None
+        else:
+            stored = interface.store.get(sid)
+        if not stored:
+            return {}
+
+        data, expires = stored
+        if expires - datetime.utcnow() <= self.app.permanent_session_lifetime / 2:
+            # renewing the session is left to StoreSessionInterface.save_session
+            raise Fallback
+        return interface.serializer.loads(data)
+
+    async def authenticate(self, request):
+        """ Session and verified token claims (None without a local verifier), as login_required checks them """
+        session = await self.session(request)
+        if 'access_token' not in session:
+            raise Abort({'message': 'Login required.'}, 418)
+
+        verifier = get_verifier()
+        if not verifier.enabled:
+            return session, None
+        try:
+            if verifier.jwks_url:
+                # an unknown key is fetched from the token service, which mustn't block the loop
+                return session, await run_in_threadpool(verifier.verify, session['access_token'])
+            return session, verifier.verify(session['access_token'])
+        except InvalidToken as e:
+            raise Abort({'message': 'Invalid token', 'content': {'msg': str(e)}}, 400)
+
+    async def ask_token_service(self, path, session):
+        resp = await self.token_service.get(path, headers={'Authorization': f'Bearer {session["access_token"]}'})
+        return resp.json()
+
+    async def role(self, session, claims):
+        if claims is not None:
+            return claims['user_role']
+        return (await self.ask_token_service('/user_role', session))['user_role']
+
+    async def me(self, request):
+        session, claims = await self.authenticate(request)
+        if claims is not None:
+            return await self.profile(request, claims['user_id'])
+
+        response = await self.ask_token_service('/user_id', session)
+        if 'user_id' not in response:
+            raise Abort({'message': 'Invalid token', 'content': response}, 400)
+        return await self.profile(request, response['user_id'])
+
+    async def user(self, request):
+        return await self.profile(request, request.path_params['user_id'])
+
+    async def profile(self, request, user_id):
+        cached = UserModel.profile_cache.get(user_id)
+        profile_cache_requests.inc(result='hit' if cached else 'miss')
+        if not cached:
+            cached = await self.coalesce(('profile', user_id), lambda: self.load_profile(user_id))
+        if not cached:
+            raise Abort({'message': 'User not found'}, 404)
+
+        profile, version = cached
+        etag = UserModel.make_etag(user_id, version)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        return JSONResponse({'message': 'Success', 'content': profile}, headers={'ETag': quote_etag(etag)})
+
+    async def load_profile(self, user_id):
+        cache = UserModel.profile_cache
+        invalidations = cache.invalidations
+        columns = UserModel.__table__.c
+        rows = await self.fetch(
+            select([columns[field] for field in UserModel.PUBLIC_FIELDS] + [columns.version])
+            .where(columns.id == user_id)
+        )
+        if not rows:
+            return None
+        cached = UserModel.serialize(rows[0]), rows[0].version
+        cache.set_unless_invalidated(user_id, cached, invalidations)
+        return cached
+
+    async def list_version(self):
+        row = (await self.fetch(UserModel.last_changes()))[0]
+        settle_seconds = self.app.config.get('CHANGES_SETTLE_SECONDS', 0)
+        return UserModel.make_list_version(row.changed, row.deleted, settle_seconds)
+
+    async def find_users(self, fields, limit=None, after=None):
+        """ The given fields of the users, a keyset page of them if `limit` is given """
+        columns = UserModel.__table__.c
+        names = list(fields)
+        if limit is not None:
+            names += [name for name in ('registration_date', 'id') if name not in fields]
+        query = select([columns[name] for name in names])
+        if limit is not None:
+            query = query.order_by(columns.registration_date, columns.id).limit(limit)
+        if after:
+            query = query.where(tuple_(columns.registration_date, columns.id) > after)
+        return await self.fetch(query)
+
+    @staticmethod
+    def list_fields(is_admin):
+        return UserModel.PUBLIC_FIELDS if is_admin else ('username',)
+
+    async def users(self, request):
+        session, claims = await self.authenticate(request)
+        args = request.query_params
+        if 'stream' in args:
+            raise Fallback
+        try:
+            limit = int(args['limit']) if 'limit' in args else None
+        except ValueError:
+            raise Fallback
+
+        paged = limit is not None or bool(args.get('after'))
+        after = None
+        if paged:
+            limit = UserList.PAGE_MAX if limit is None else min(limit, UserList.PAGE_MAX)
+            if args.get('after'):
+                try:
+                    registration_date, user_id = decode_cursor(args['after'], 2)
+                    after = parse_datetime(registration_date), user_id
+                except ValueError:
+                    after = ValueError
+
+        # the role, the list version and the users don't depend on each other; the users are only
+        # fetched upfront when the client has no copy which could still be current, and when the
+        # role is in the token, as it decides which fields may be read
+        page = limit if paged else None, after
+        waits = [self.role(session, claims), self.list_version()]
+        fetch_early = claims is not None and 'if-none-match' not in request.headers \
+            and (not paged or limit >= 1 and after is not ValueError)
+        if fetch_early:
+            waits.append(self.find_users(self.list_fields(claims['user_role'] == 'ADMIN'), *page))
+        role, version, *rows = await asyncio.gather(*waits)
+        is_admin = role == 'ADMIN'
+
+        etag = UserList.make_etag(version, is_admin, request.scope['query_string'])
+        if etag_matches(request, etag):
+            return not_modified(etag)
+
+        if paged and limit < 1:
+            raise Abort({'message': 'Limit must be a positive number.'}, 400)
+        if after is ValueError:
+            raise Abort({'message': 'Invalid cursor.'}, 400)
+
+        rows = rows[0] if fetch_early else await self.find_users(self.list_fields(is_admin), *page)
+        body = {
+            'message': 'Success.' if is_admin else UserList.NON_ADMIN_MESSAGE,
+            'content': [UserModel.serialize(row) if is_admin else row.username for row in rows],
+        }
+        if paged:
+            body['next'] = encode_cursor(rows[-1].registration_date, rows[-1].id) if len(rows) == limit else None
+        return JSONResponse(body, headers=etag_header(etag))
+
+    async def user_batch(self, request):
+        # bodies which reqparse would coerce or reject with its own wording are left to Flask
+        if request.headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+            raise Fallback
+        try:
+            data = await request.json()
+        except ValueError:
+            raise Fallback
+        if not isinstance(data, dict):
+            raise Fallback
+        ids, fields = data.get('ids'), data.get('fields')
+        if not ids or not is_string_list(ids) or fields is not None and not is_string_list(fields):
+            raise Fallback
+
+        ids = list(dict.fromkeys(ids))
+        fields = fields or UserModel.PUBLIC_FIELDS
+        if len(ids) > UserBatch.MAX_IDS:
+            raise Abort({'message': f'At most {UserBatch.MAX_IDS} users can be looked up at once.'}, 400)
+        unknown = [field for field in fields if field not in UserModel.PUBLIC_FIELDS]
+        if unknown:
+            raise Abort({'message': f'Unknown fields: {", ".join(unknown)}.'}, 400)
+
+        columns = UserModel.__table__.c
+        names = list(dict.fromkeys(list(fields) + ['id']))
+        rows = await self.fetch(select([columns[name] for name in names]).where(columns.id.in_(ids)))
+        users = {row.id: UserModel.serialize(row, fields) for row in rows}
+
+        return JSONResponse({
+            'message': 'Success.',
+            'content': {
+                'users': users,
+                'missing': [user_id for user_id in ids if user_id not in users],
+            },
+        })
+
+
+def create_asgi_app(config='config.ProductionConfig'):
+    server = AsyncServer(create_app(config))
+    return Starlette(routes=server.routes(), lifespan=server.lifespan)
+
+
+def main():
+    """ App factory of each uvicorn worker """
+    return create_asgi_app(os.environ.get('APP_CONFIG', 'config.ProductionConfig'))
+
+
+def serve():
+    import uvicorn
+
+    host, _, port = os.environ.get('BIND', '0.0.0.0:5000').rpartition(':')
+    workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+    # sizes the hashing pool of each worker, see hashing.PasswordHasher
+    os.environ['WEB_WORKERS'] = str(workers)
+    shared_metrics.reset()
+    uvicorn.run(
+        'asgi:main', factory=True, host=host, port=int(port), workers=workers,
+        timeout_keep_alive=int(os.environ.get('WEB_KEEPALIVE', 5)),
+    )
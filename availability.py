@@ -0,0 +1,129 @@
+"""
+Process-wide Bloom filter of the usernames and emails in use, so availability checks of free
+names are answered without a query.
+
+A background thread in each process builds the filter with a streaming scan of the users table.
+Every AVAILABILITY_SYNC_INTERVAL seconds it then adds the users changed since its previous pass
+(found through the indexed updated_at), which picks up names registered through other processes.
+Names of deleted users stay in the filter. That is safe, because every possible positive is
+checked against the database. The filter is rebuilt once it holds more names than it was sized for.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from db import db
+from models.user import UserModel
+from process_local import PerProcess
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = float(os.environ.get('AVAILABILITY_SYNC_INTERVAL', 5))
+ERROR_RATE = float(os.environ.get('AVAILABILITY_ERROR_RATE', 0.01))
+MIN_CAPACITY = 100000
+# changes committed late, by transactions which started before a pass, are caught by the next one
+SYNC_OVERLAP = timedelta(seconds=10)
+
+
+class BloomFilter:
+    """ Set without false negatives, having about `error_rate` false positives when filled to `capacity` """
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, value):
+        # double hashing: k positions derived from the two halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        positions = self._positions(value)
+        with self._lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+def _key(kind, value):
+    return f'{kind}:{value.lower()}'
+
+
+class TakenNames:
+    def __init__(self):
+        self._filter = None
+        self._synced_at = None
+        self._thread = PerProcess(self._start)
+
+    def start(self, app):
+        """ Keeps the filter of this process up to date from a background thread """
+        self._thread.get(app)
+
+    def _start(self, app):
+        self._filter = None
+        thread = threading.Thread(target=self._run, args=(app,), name='availability-sync', daemon=True)
+        thread.start()
+        return thread
+
+    def might_be_taken(self, kind, value):
+        """ False only if `value` is certainly not in use; always True until the filter is built """
+        bloom = self._filter
+        return bloom is None or _key(kind, value) in bloom
+
+    def add(self, **names):
+        bloom = self._filter
+        if bloom is not None:
+            for kind, value in names.items():
+                bloom.add(_key(kind, value))
+
+    def build(self):
+        started = datetime.now()
+        # two names per user, with room for the table to double before a rebuild
+        bloom = BloomFilter(max(MIN_CAPACITY, 4 * UserModel.count_where()))
+        for row in UserModel.iter_all(('username', 'email')):
+            bloom.add(_key('username', row.username))
+            bloom.add(_key('email', row.email))
+        self._filter, self._synced_at = bloom, started
+
+    def sync(self, batch_size=1000):
+        """ Adds users changed since the previous pass, or rebuilds the filter if it's missing or full """
+        bloom = self._filter
+        if bloom is None or bloom.count > bloom.capacity:
+            return self.build()
+
+        started = datetime.now()
+        after = self._synced_at - SYNC_OVERLAP, ''
+        while True:
+            rows = UserModel.find_changed(batch_size, after, fields=('username', 'email'))
+            for row in rows:
+                bloom.add(_key('username', row.username))
+                bloom.add(_key('email', row.email))
+            if len(rows) < batch_size:
+                break
+            after = rows[-1].updated_at, rows[-1].id
+        self._synced_at = started
+
+    def _run(self, app):
+        with app.app_context():
+            while True:
+                try:
+                    self.sync()
+                except Exception:
+                    logger.exception('Failed to sync the taken names filter')
+                finally:
+                    db.session.remove()
+                time.sleep(SYNC_INTERVAL)
+
+
+taken_names = TakenNames()
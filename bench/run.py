@@ -0,0 +1,294 @@
+"""
+Load benchmark of the users service against local stand-ins of its upstreams.
+
+    python -m bench.run --concurrency 16 --duration 30 --output bench.json --baseline baseline.json
+
+The app is served from a background thread with a SQLite database (or --database), stub token and
+score services, and driven by worker threads issuing a weighted mix of requests. Each worker keeps
+its own session and logs in as its own user. Results are printed and saved as JSON; when a baseline
+is given, p95 latency and throughput are compared against it. The exit status is 1 if any request
+failed or an endpoint regressed.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import requests
+
+from bench.stubs import SECRET_KEY, Server, create_token_service, create_score_service
+
+DEFAULT_MIX = 'register=1,login=2,me=6,users=1,user=6'
+
+
+def random_name(length=12):
+    return ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(length))
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'Unknown endpoint {name}, choose from {", ".join(SCENARIOS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class Client:
+    """ One simulated user with its own cookie jar """
+    def __init__(self, base_url, user_ids):
+        self.base_url = base_url
+        self.user_ids = user_ids
+        self.http = requests.Session()
+        self.username = random_name()
+        self.password = random_name()
+
+    def call(self, method, path, **kwargs):
+        return self.http.request(method, f'{self.base_url}{path}', **kwargs)
+
+    def register(self, username=None, password=None):
+        username = username or random_name()
+        return self.call('POST', '/register', data={
+            'username': username,
+            'password1': password or 'password',
+            'password2': password or 'password',
+            'email': f'{username}@bench.com',
+        })
+
+    def login(self):
+        return self.call('POST', '/login', data={'username': self.username, 'password': self.password})
+
+    def me(self):
+        return self.call('GET', '/me')
+
+    def users(self):
+        return self.call('GET', '/users', params={'limit': 50})
+
+    def user(self):
+        return self.call('GET', f'/user/{random.choice(self.user_ids)}')
+
+
+SCENARIOS = {
+    'register': Client.register,
+    'login': Client.login,
+    'me': Client.me,
+    'users': Client.users,
+    'user': Client.user,
+}
+
+
+def configure_app(database):
+    from app import create_app
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database
+        SQLALCHEMY_TRACK_MODIFICATIONS = False
+        SECRET_KEY = 'bench'
+        SESSION_TYPE = 'memory'
+
+    return create_app(BenchConfig)
+
+
+def seed(app, users):
+    from bootstrap import init_db
+    from models.user import UserModel
+
+    with app.app_context():
+        init_db()
+        created, _ = UserModel.bulk_create([
+            {'username': random_name(), 'password': 'password', 'email': f'{random_name()}@seed.com'}
+            for _ in range(users)
+        ])
+    return created
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_load(base_url, user_ids, mix, concurrency, duration):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    names, weights = zip(*mix.items())
+    deadline = time.monotonic() + duration
+    start_barrier = threading.Barrier(concurrency)
+
+    def worker():
+        client = Client(base_url, user_ids)
+        client.register(client.username, client.password)
+        client.login()
+        local = defaultdict(list)
+        local_errors = defaultdict(int)
+        start_barrier.wait()
+
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                resp = SCENARIOS[name](client)
+                ok = resp.status_code < 400 or (name == 'register' and resp.status_code == 400)
+            except requests.RequestException:
+                ok = False
+            local[name].append(time.perf_counter() - start)
+            if not ok:
+                local_errors[name] += 1
+
+        with lock:
+            for name, values in local.items():
+                latencies[name].extend(values)
+            for name, count in local_errors.items():
+                errors[name] += count
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    results = {}
+    for name, values in latencies.items():
+        results[name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'throughput_rps': round(len(values) / elapsed, 2),
+            'p50_ms': round(1000 * percentile(values, .50), 2),
+            'p95_ms': round(1000 * percentile(values, .95), 2),
+            'p99_ms': round(1000 * percentile(values, .99), 2),
+        }
+    total = sum(len(values) for values in latencies.values())
+    return results, {'requests': total, 'throughput_rps': round(total / elapsed, 2), 'elapsed_s': round(elapsed, 2)}
+
+
+def measure_allocations(app, user_ids, samples):
+    """ Peak memory allocated while serving one request, measured in-process with tracemalloc """
+    client = Client('', user_ids)
+    test_client = app.test_client()
+    client.call = lambda method, path, **kwargs: test_client.open(
+        path, method=method, data=kwargs.get('data'), query_string=kwargs.get('params'))
+    client.register(client.username, client.password)
+    client.login()
+
+    allocations = {}
+    tracemalloc.start()
+    try:
+        for name, scenario in SCENARIOS.items():
+            peaks = []
+            for _ in range(samples):
+                tracemalloc.clear_traces()
+                before = tracemalloc.get_traced_memory()[0]
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                scenario(client)
+                peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            allocations[name] = round(sum(peaks) / len(peaks) / 1024, 2)
+    finally:
+        tracemalloc.stop()
+    return allocations
+
+
+def compare(results, baseline, max_regression):
+    """ Prints the change against the baseline; returns False if any endpoint regressed too much """
+    ok = True
+    for name, current in sorted(results['endpoints'].items()):
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            continue
+        p95 = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] if previous['p95_ms'] else 0
+        rps = (current['throughput_rps'] - previous['throughput_rps']) / previous['throughput_rps'] \
+            if previous['throughput_rps'] else 0
+        regressed = p95 > max_regression or -rps > max_regression
+        ok = ok and not regressed
+        print(f'{name:10} p95 {p95:+8.1%}  throughput {rps:+8.1%}{"  REGRESSION" if regressed else ""}')
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load per run')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'weighted endpoint mix, default: {DEFAULT_MIX}')
+    parser.add_argument('--users', type=int, default=1000, help='users seeded before the run')
+    parser.add_argument('--database', help='SQLAlchemy URI, defaults to a temporary SQLite file')
+    parser.add_argument('--alloc-samples', type=int, default=20, help='requests per endpoint traced for allocations')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='fail if p95 or throughput of an endpoint get worse by more than this fraction')
+    args = parser.parse_args(argv)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logging.getLogger('metrics').setLevel(logging.ERROR)
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='bench-db-'), 'users.db')
+
+    with Server(create_token_service()) as token_service, Server(create_score_service()) as score_service:
+        os.environ['TOKEN_SERVICE'] = token_service.url
+        os.environ['SCORE_SERVICE'] = score_service.url
+        os.environ.setdefault('JWT_SECRET_KEY', SECRET_KEY)
+
+        app = configure_app(database)
+        user_ids = seed(app, args.users)
+
+        with Server(app) as server:
+            endpoints, total = run_load(server.url, user_ids, args.mix, args.concurrency, args.duration)
+
+        for name, kib in measure_allocations(app, user_ids, args.alloc_samples).items():
+            if name in endpoints:
+                endpoints[name]['alloc_peak_kib'] = kib
+
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'database': database.split(':', 1)[0],
+            'concurrency': args.concurrency,
+            'duration_s': args.duration,
+            'mix': args.mix,
+            'seeded_users': args.users,
+        },
+        'total': total,
+        'endpoints': endpoints,
+    }
+
+    print(f'{"endpoint":10} {"requests":>9} {"errors":>7} {"rps":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} '
+          f'{"alloc KiB":>10}')
+    for name, stats in sorted(endpoints.items()):
+        print(f'{name:10} {stats["requests"]:9} {stats["errors"]:7} {stats["throughput_rps"]:9} {stats["p50_ms"]:9} '
+              f'{stats["p95_ms"]:9} {stats["p99_ms"]:9} {stats.get("alloc_peak_kib", "-"):>10}')
+    print(f'total: {total["requests"]} requests, {total["throughput_rps"]} req/s')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failing = sorted(name for name, stats in endpoints.items() if stats['errors'])
+    if failing:
+        print(f'errors on {", ".join(failing)}, the run is not a valid measurement')
+        return 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            if not compare(results, json.load(f), args.max_regression):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+""" Local stand-ins for the token and score services, good enough to drive the users service under load """
+import threading
+import time
+import uuid
+
+import jwt
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+SECRET_KEY = 'bench-secret-key-which-is-long-enough-for-hs256'
+TOKEN_TTL = 3600
+
+
+def create_token_service(secret=SECRET_KEY):
+    app = Flask('token-service-stub')
+
+    def claims():
+        token = request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        try:
+            return jwt.decode(token, secret, algorithms=['HS256'])
+        except jwt.PyJWTError as e:
+            return {'msg': str(e)}
+
+    @app.route('/token')
+    def token():
+        now = int(time.time())
+        access_token = jwt.encode({
+            'identity': request.args['user_id'],
+            'user_claims': {'role': request.args['role']},
+            'jti': str(uuid.uuid4()),
+            'type': 'access',
+            'iat': now,
+            'exp': now + TOKEN_TTL,
+        }, secret, algorithm='HS256')
+        return jsonify(access_token=access_token)
+
+    @app.route('/user_id')
+    def user_id():
+        payload = claims()
+        if 'identity' not in payload:
+            return jsonify(payload), 401
+        return jsonify(user_id=payload['identity'])
+
+    @app.route('/user_role')
+    def user_role():
+        payload = claims()
+        if 'user_claims' not in payload:
+            return jsonify(payload), 401
+        return jsonify(user_role=payload['user_claims']['role'])
+
+    @app.route('/blacklist')
+    def blacklist():
+        return jsonify(message='Token revoked.')
+
+    return app
+
+
+def create_score_service():
+    app = Flask('score-service-stub')
+
+    @app.route('/scores/<string:user_id>', methods=['DELETE'])
+    def delete_user_scores(user_id):
+        return jsonify(message='Scores deleted.')
+
+    @app.route('/scores', methods=['DELETE'])
+    def delete_scores():
+        return jsonify(message='Scores deleted.')
+
+    return app
+
+
+class Server:
+    """ Serves a WSGI app from a background thread on a free local port """
+    def __init__(self, app, host='127.0.0.1', port=0):
+        self._server = make_server(host, port, app, threaded=True)
+        self.url = f'http://{host}:{self._server.server_port}'
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
@@ -0,0 +1,208 @@
+import logging
+import os
+import re
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex
+
+from db import db, insert_ignoring_conflicts
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH = int(os.environ.get('MIGRATION_BATCH', 1000))
+
+# indexes of earlier versions which newer ones made redundant
+REPLACED_INDEXES = ('ix_outbox_available_at_id',)
+
+
+def init_db():
+    """
+    Creates missing tables, migrates existing ones and seeds the roles and the admin user.
+    Safe to run any number of times: existing rows are left alone.
+    """
+    from hashing import hasher
+    from models.role import Role
+    from models.user import UserModel
+    from sessions import DatabaseStore
+
+    db.create_all()
+    migrate()
+    store = getattr(current_app.session_interface, 'store', None)
+    if isinstance(store, DatabaseStore):
+        store.create_table()
+
+    insert_ignoring_conflicts(Role.__table__, [{'name': 'ADMIN'}, {'name': 'USER'}])
+    Role.invalidate_cache()
+
+    if not UserModel.version_of('0'):
+        insert_ignoring_conflicts(UserModel.__table__, [
+            UserModel.bulk_row({
+                'user_id': '0',
+                'username': 'admin',
+                'email': 'admin@admin.com',
+                'role_id': Role.id_of('ADMIN'),
+            }, hasher.hash('admin')),
+        ])
+
+    db.session.commit()
+
+
+def migrate():
+    """
+    Brings tables made by earlier versions of the service up to date, as create_all leaves existing
+    tables alone: adds and backfills the missing columns of the users table (updated_at, and the
+    email_domain which purging and domain search filter on) and the failed_at column of the outbox,
+    widens columns which have grown and creates missing indexes, dropping ones which were replaced.
+
+    Backfills run in batches of MIGRATION_BATCH rows, each committed on its own. On Postgres indexes
+    are built CONCURRENTLY, so the service can keep writing meanwhile; an index left invalid by a build
+    which failed (e.g. on usernames differing only in case) is dropped and built again.
+    """
+    from models.outbox import OutboxMessage
+    from models.user import UserModel, POSTGRES_INDEXES
+
+    users = UserModel.__table__
+    outbox = OutboxMessage.__table__
+    # CONCURRENTLY can't run inside a transaction, and index builds may outlast the statement timeout
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        postgres = connection.dialect.name == 'postgresql'
+        if postgres:
+            connection.exec_driver_sql('SET statement_timeout = 0')
+
+        columns = {column['name']: column for column in inspect(connection).get_columns(users.name)}
+        if 'version' not in columns:
+            _add_column(connection, users.c.version, 'NOT NULL DEFAULT 1')
+        if 'email_domain' not in columns:
+            _add_column(connection, users.c.email_domain)
+        if 'updated_at' not in columns:
+            _add_column(connection, users.c.updated_at)
+        _backfill(connection, 'updated_at = COALESCE(registration_date, CURRENT_TIMESTAMP)', 'updated_at IS NULL')
+        _backfill_email_domains(connection)
+        if postgres and columns.get('updated_at', {}).get('nullable', True):
+            connection.exec_driver_sql('ALTER TABLE users ALTER COLUMN updated_at SET NOT NULL')
+        if postgres and columns['password']['type'].length < users.c.password.type.length:
+            # widening a varchar doesn't rewrite the table
+            password_type = users.c.password.type.compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f'ALTER TABLE users ALTER COLUMN password TYPE {password_type}')
+        if 'failed_at' not in {column['name'] for column in inspect(connection).get_columns(outbox.name)}:
+            _add_column(connection, outbox.c.failed_at)
+
+        indexes = {
+            index.name: _create_index_sql(index, connection.dialect)
+            for table in db.metadata.sorted_tables for index in table.indexes
+        }
+        if postgres:
+            indexes.update({
+                name: f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}'
+                for name, definition in POSTGRES_INDEXES.items()
+            })
+            invalid = connection.exec_driver_sql(
+                'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid'
+            ).scalars().all()
+            for name in set(invalid) & set(indexes):
+                connection.exec_driver_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        for statement in indexes.values():
+            connection.exec_driver_sql(statement)
+        for name in REPLACED_INDEXES:
+            connection.exec_driver_sql(f'DROP INDEX {"CONCURRENTLY " if postgres else ""}IF EXISTS {name}')
+
+
+def _add_column(connection, column, constraints=''):
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f'ALTER TABLE {column.table.name} ADD COLUMN {column.name} {column_type} {constraints}')
+
+
+def _backfill(connection, assignment, condition, batch_size=MIGRATION_BATCH):
+    """ Sets `assignment` on the users matching `condition`, `batch_size` rows per statement """
+    while True:
+        count = connection.exec_driver_sql(
+            f'UPDATE users SET {assignment} WHERE id IN (SELECT id FROM users WHERE {condition} LIMIT {batch_size})'
+        ).rowcount
+        if count < batch_size:
+            return
+
+
+def _backfill_email_domains(connection, batch_size=MIGRATION_BATCH):
+    """ Fills in the email_domain of users which have none, the same way UserModel does """
+    from models.user import UserModel
+
+    users = UserModel.__table__
+    while True:
+        rows = connection.execute(
+            db.select([users.c.id, users.c.email]).where(users.c.email_domain.is_(None)).limit(batch_size)
+        ).fetchall()
+        if rows:
+            connection.execute(
+                users.update().where(users.c.id == db.bindparam('user_id'))
+                .values(email_domain=db.bindparam('domain')),
+                [{'user_id': row.id, 'domain': UserModel.domain_of(row.email)} for row in rows],
+            )
+        if len(rows) < batch_size:
+            return
+
+
+def _create_index_sql(index, dialect):
+    statement = str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect))
+    if dialect.name == 'postgresql':
+        statement = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', statement)
+    return statement
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """ Create the tables and seed rows the service needs. """
+    init_db()
+    click.echo('Database initialized.')
+
+
+def warm_up(app):
+    """
+    Readies a worker before it takes traffic: opens its pool connections and fills the caches
+    and HTTP sessions which would otherwise be set up by the first requests.
+
+    A step which fails, e.g. while the database or the key set is unreachable, is logged and
+    skipped. The worker still starts and the first requests set up whatever is missing, so
+    a short outage while workers are (re)spawned doesn't take the server down.
+    """
+    from availability import taken_names
+    from models.role import Role
+    from tokens import get_verifier
+    from upstream import token_service, score_service
+
+    def open_connections():
+        pool_size = getattr(db.engine.pool, 'size', None)
+        connections = int(os.environ.get('WARM_UP_CONNECTIONS', pool_size() if pool_size else 1))
+        opened = []
+        try:
+            for _ in range(connections):
+                opened.append(db.engine.connect())
+                opened[-1].execute(db.text('SELECT 1'))
+        finally:
+            for connection in opened:
+                connection.close()
+
+    def create_http_sessions():
+        for client in (token_service, score_service):
+            client.session  # created lazily per process
+
+    steps = [
+        open_connections,
+        Role.names,
+        lambda: taken_names.start(app),
+        lambda: get_verifier().start(app),
+        get_verifier().prime,
+        create_http_sessions,
+    ]
+    with app.app_context():
+        try:
+            for step in steps:
+                try:
+                    step()
+                except Exception:
+                    logger.exception('Warm-up step failed, continuing without it')
+        finally:
+            db.session.remove()
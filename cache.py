@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ Thread-safe LRU cache whose entries also expire after `ttl` seconds """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        # bumped whenever an entry is dropped, see set_unless_invalidated
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def set_unless_invalidated(self, key, value, invalidations, ttl=None):
+        """
+        Caches a value loaded outside of get_or_load, unless any entry was dropped since
+        `invalidations` was read before loading it, in which case the value may be stale.
+        """
+        with self._lock:
+            if self.invalidations == invalidations:
+                self._store(key, value, ttl)
+
+    def _store(self, key, value, ttl):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get_or_load(self, key, load, ttl=None):
+        """
+        Returns the cached value of `key`, calling `load()` to fill it on a miss. Concurrent misses
+        of a key wait for a single `load()` instead of making their own. None is returned, but not cached.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            flight = self._loading.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._loading[key] = _Flight()
+        if not leader:
+            return flight.result()
+
+        try:
+            flight.value = load()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+                # a value loaded while the key was invalidated may already be stale
+                if flight.value is not None and not flight.stale:
+                    self._store(key, flight.value, ttl)
+            flight.done.set()
+        return flight.value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            flight = self._loading.get(key)
+            if flight:
+                flight.stale = True
+            item = self._data.pop(key, None)
+            self.invalidations += 1
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.invalidations += 1
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Flight:
+    """ A load in progress, which other callers wait for """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+    def result(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.value
+
+
+_MISSING = object()
@@ -1,6 +1,30 @@
 import os
+from datetime import timedelta
 
 from credentials import dbURI_dev, dbURI_test
+from db import TimedQueuePool
+
+
+def engine_options():
+    """ Connection pool and per-statement limits for Postgres, tunable through the environment """
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        'connect_args': {
+            'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5)),
+            'options': '-c statement_timeout={}'.format(int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))),
+        },
+    }
+
+
+def replica_binds():
+    """ Binds for the read replicas listed, comma separated, in DATABASE_REPLICA_URLS """
+    urls = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    return {'replica_{}'.format(i): url for i, url in enumerate(urls)}
 
 
 class Config:
@@ -8,13 +32,25 @@ class Config:
     TESTING = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SECRET_KEY = os.urandom(16)
-    SESSION_TYPE = 'filesystem'
+    # 'memory', 'database' or any type supported by Flask-Session, see sessions.py
+    SESSION_TYPE = os.environ.get('SESSION_TYPE', 'database')
+    SESSION_DATABASE_URI = os.environ.get('SESSION_DATABASE_URI')
+    PERMANENT_SESSION_LIFETIME = timedelta(seconds=int(os.environ.get('SESSION_LIFETIME', 24 * 60 * 60)))
+    SQLALCHEMY_BINDS = replica_binds()
+    SQLALCHEMY_REPLICA_BINDS = list(SQLALCHEMY_BINDS)
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    # the change feed only reports changes at least this old, so transactions which were still
+    # in flight (or not yet replicated) when a page was read can't be skipped by its cursor;
+    # for the same reason /users isn't tagged for conditional requests until its last change is this old
+    CHANGES_SETTLE_SECONDS = float(os.environ.get('CHANGES_SETTLE_SECONDS', 2))
+    OUTBOX_DISPATCH = os.environ.get('OUTBOX_DISPATCH', '1') == '1'
 
 
 class DevelopmentConfig(Config):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = 'postgresql://{user}:{password}@{host}:{port}/{db}'.format(**dbURI_dev)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options()
     PROPAGATE_EXCEPTIONS = True
 
 
@@ -23,4 +59,17 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'postgresql://{user}:{password}@{host}:{port}/{db}'.format(**dbURI_test)
     SQLALCHEMY_TRACK_MODIFICATIONS = True
-    PROPAGATE_EXCEPTIONS = True
\ No newline at end of file
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options()
+    PROPAGATE_EXCEPTIONS = True
+    CHANGES_SETTLE_SECONDS = 0
+    SESSION_TYPE = 'memory'
+    # tests deliver the outbox explicitly
+    OUTBOX_DISPATCH = False
+
+
+class ProductionConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'postgresql://{user}:{password}@{host}:{port}/{db}'.format(**dbURI_dev))
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options()
+    SECRET_KEY = os.environ.get('SECRET_KEY', Config.SECRET_KEY)
@@ -1,3 +1,125 @@
-from flask_sqlalchemy import SQLAlchemy
+import itertools
+import threading
+import time
 
-db = SQLAlchemy()
\ No newline at end of file
+from flask import session, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import exc, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+from metrics import pool_checkout_wait, pool_checkout_timeouts
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session which sends reads round-robin to the replica binds listed in SQLALCHEMY_REPLICA_BINDS
+    and everything else to the primary.
+
+    Flushes, DML statements, locking reads and anything inside a transaction which has already
+    written go to the primary. After a committed write, reads stay on the primary for
+    REPLICA_STICKY_SECONDS, both in this session and in the user's later requests, so callers
+    always see their own writes despite replication lag.
+    """
+    _replica_cycle = itertools.count()
+
+    def __init__(self, db, *args, **kwargs):
+        super().__init__(db, *args, **kwargs)
+        self.db = db
+        self._wrote = False
+        self._primary_until = 0
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.config.get('SQLALCHEMY_REPLICA_BINDS')
+        if not replicas or self._needs_primary(clause):
+            if self._flushing or isinstance(clause, UpdateBase):
+                self._wrote = True
+            return super().get_bind(mapper, clause)
+
+        replica = replicas[next(self._replica_cycle) % len(replicas)]
+        return self.db.get_engine(self.app, bind=replica)
+
+    def _needs_primary(self, clause):
+        if self._flushing or self._wrote or isinstance(clause, UpdateBase):
+            return True
+        if getattr(clause, '_for_update_arg', None) is not None:
+            return True
+        if self._primary_until > time.time():
+            return True
+        return has_request_context() and session.get('db_primary_until', 0) > time.time()
+
+    def commit(self):
+        super().commit()
+        if self._wrote:
+            self._wrote = False
+            self._primary_until = time.time() + self.app.config.get('REPLICA_STICKY_SECONDS', 5)
+            if has_request_context() and self.app.config.get('SQLALCHEMY_REPLICA_BINDS'):
+                session['db_primary_until'] = self._primary_until
+
+    def rollback(self):
+        super().rollback()
+        self._wrote = False
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool which records how long each connection checkout had to wait """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            pool_checkout_wait.observe(elapsed)
+            if timed_out:
+                pool_checkout_timeouts.inc()
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_time += elapsed
+                self.max_wait = max(self.max_wait, elapsed)
+
+    def stats(self):
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'idle': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            'max_overflow': self._max_overflow,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'avg_wait_ms': round(1000 * self.wait_time / self.checkouts, 3) if self.checkouts else 0,
+            'max_wait_ms': round(1000 * self.max_wait, 3),
+        }
+
+
+def insert_ignoring_conflicts(table, rows):
+    """ Inserts rows, silently skipping those which would violate a unique constraint """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE')
+    else:
+        statement = table.insert().prefix_with('IGNORE')
+    db.session.execute(statement, rows)
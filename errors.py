@@ -0,0 +1,14 @@
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class RetryLater(ServiceUnavailable):
+    """ 503 telling the client when to retry; rendered by flask-restful as {'message': description} """
+    def __init__(self, description=None, retry_after=None):
+        super().__init__(description)
+        self.retry_after = retry_after
+
+    def get_headers(self, *args, **kwargs):
+        headers = super().get_headers(*args, **kwargs)
+        if self.retry_after:
+            headers.append(('Retry-After', str(int(self.retry_after))))
+        return headers
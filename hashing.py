@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+from errors import RetryLater
+from metrics import hash_duration
+from process_local import PerProcess
+
+
+class HashingOverloaded(RetryLater):
+    def __init__(self, retry_after=1):
+        super().__init__('Too many requests, please, try again in a moment.', retry_after)
+
+
+def stored_method(method):
+    """ The method prefix werkzeug stores in hashes made with `method`, which spells out the default cost """
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        return f'{method}:{DEFAULT_PBKDF2_ITERATIONS}'
+    return method
+
+
+def hash_all(passwords, method):
+    return [generate_password_hash(password, method) for password in passwords]
+
+
+class PasswordHasher:
+    """
+    Runs password key derivation on a dedicated process pool, so it neither holds the GIL
+    nor occupies the request threads serving cheap endpoints.
+
+    At most PASSWORD_HASH_WORKERS jobs run and PASSWORD_HASH_QUEUE more wait; beyond that
+    new jobs are refused right away with HashingOverloaded. PASSWORD_HASH_WORKERS=0 hashes
+    in the calling thread. PASSWORD_HASH_METHOD sets the werkzeug method and cost of new hashes.
+
+    Every web worker process has its own pool and admission, so PASSWORD_HASH_WORKERS defaults
+    to the CPU cores divided by WEB_WORKERS (at least 1): together the pools then use about
+    every core, and the machine takes at most WEB_WORKERS * (PASSWORD_HASH_WORKERS +
+    PASSWORD_HASH_QUEUE) jobs. The servers pass their worker count on in WEB_WORKERS.
+
+    Bulk jobs are split into chunks of PASSWORD_HASH_CHUNK passwords which go through the same
+    admission, at most PASSWORD_HASH_WORKERS of them at a time, so logins still get a turn.
+    """
+    def __init__(self):
+        self.method = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+        web_workers = int(os.environ.get('WEB_WORKERS', 1))
+        self.workers = int(os.environ.get('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 1) // web_workers)))
+        self.queue_size = int(os.environ.get('PASSWORD_HASH_QUEUE', self.workers * 4))
+        self.timeout = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+        self.chunk_size = int(os.environ.get('PASSWORD_HASH_CHUNK', 8))
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self._executor = PerProcess(lambda: ProcessPoolExecutor(self.workers))
+
+    @property
+    def executor(self):
+        return self._executor.get()
+
+    def _submit(self, fn, *args, timeout=None, on_done=None):
+        """ Submits a job once it's admitted, waiting up to `timeout` seconds for a slot if given """
+        admitted = self._slots.acquire(timeout=timeout) if timeout else self._slots.acquire(blocking=False)
+        if not admitted:
+            raise HashingOverloaded()
+
+        def release(_):
+            self._slots.release()
+            if on_done:
+                on_done()
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            release(None)
+            raise
+        # the slot is only freed once the job is done, even if we stop waiting for it
+        future.add_done_callback(release)
+        return future
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        try:
+            return self._submit(fn, *args).result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingOverloaded()
+
+    def hash(self, password):
+        start = time.perf_counter()
+        try:
+            return self._run(generate_password_hash, password, self.method)
+        finally:
+            hash_duration.observe(time.perf_counter() - start, operation='hash')
+
+    def check(self, pwhash, password):
+        start = time.perf_counter()
+        try:
+            return self._run(check_password_hash, pwhash, password)
+        finally:
+            hash_duration.observe(time.perf_counter() - start, operation='check')
+
+    def hash_many(self, passwords):
+        """ Hashes a batch of passwords, waiting for admission rather than refusing; meant for admin bulk operations """
+        passwords = list(passwords)
+        if not self.workers:
+            return hash_all(passwords, self.method)
+        in_flight = threading.BoundedSemaphore(self.workers)
+        futures = []
+        try:
+            for start in range(0, len(passwords), self.chunk_size):
+                in_flight.acquire()
+                try:
+                    futures.append(self._submit(hash_all, passwords[start:start + self.chunk_size], self.method,
+                                                timeout=self.timeout, on_done=in_flight.release))
+                except Exception:
+                    in_flight.release()
+                    raise
+            return [pwhash for future in futures for pwhash in future.result()]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def needs_rehash(self, pwhash):
+        """ Whether the hash was made with a different method or cost than the current one """
+        return pwhash.split('$', 1)[0] != stored_method(self.method)
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,342 @@
+"""
+Prometheus metrics of the service, served at /metrics.
+
+Metrics are kept in each process. Under a server with several worker processes, set METRICS_DIR
+to a directory only this server uses: every process then writes its values to a file there every
+METRICS_FLUSH_INTERVAL seconds (5) and when it exits, and /metrics adds up the files of all
+workers, past ones included, so counters don't go back when a worker is recycled. Gauges set by
+the workers are reported per live process, with a `pid` label. The servers empty the directory
+when they start.
+"""
+import atexit
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request, has_app_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from process_local import PerProcess
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def items(self):
+        """ (label values, value) pairs recorded by this process """
+        with self._lock:
+            return list(self._values.items())
+
+    @staticmethod
+    def combine(value, other):
+        """ Value of a series recorded by two processes """
+        return value + other
+
+    def samples(self, items):
+        return [(self.name, self._format_labels(key), value) for key, value in items]
+
+    def expose(self, items=None):
+        """ Text of the metric, with the values of this process unless given the `items` to show """
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        samples = self.samples(self.items() if items is None else items)
+        lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in samples)
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        shared_metrics.start()
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge which is either set directly or computed by `callback` at scrape time. Values set by
+    several processes are told apart by the pid following the label values of their keys.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        shared_metrics.start()
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def items(self):
+        if self.callback:
+            try:
+                return [((), self.callback())]
+            except Exception:
+                logger.exception('Failed to collect %s', self.name)
+                return []
+        return super().items()
+
+    def samples(self, items):
+        size = len(self.labels)
+        return [(self.name, self._format_labels(key[:size], zip(('pid',), key[size:])), value)
+                for key, value in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        shared_metrics.start()
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = counts, total + value
+
+    def items(self):
+        with self._lock:
+            return [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+
+    @staticmethod
+    def combine(value, other):
+        return [a + b for a, b in zip(value[0], other[0])], value[1] + other[1]
+
+    def samples(self, items):
+        samples = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', self._format_labels(key, [('le', _format_value(bound))]),
+                                cumulative))
+            samples.append((f'{self.name}_sum', self._format_labels(key), total))
+            samples.append((f'{self.name}_count', self._format_labels(key), cumulative))
+        return samples
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class SharedMetrics:
+    """ Values of all processes of a server, as a file per process in `directory` (see the module docstring) """
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self._path = PerProcess(self._start)
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Starts writing the values of this process, if shared; cheap once it has started """
+        if self.directory:
+            self._path.get()
+
+    def _start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}-{secrets.token_hex(4)}.json')
+        pid = os.getpid()
+        threading.Thread(target=self._flush_loop, args=(path,), name='metrics-flush', daemon=True).start()
+        # forked children inherit exit handlers, only the process owning the file may write it
+        atexit.register(lambda: os.getpid() == pid and self._try_flush(path, final=True))
+        return path
+
+    def _flush_loop(self, path):
+        while True:
+            time.sleep(self.interval)
+            self._try_flush(path)
+
+    def _try_flush(self, path, final=False):
+        try:
+            self.flush(path, final)
+        except Exception:
+            logger.exception('Failed to write metrics to %s', path)
+
+    def flush(self, path, final=False):
+        """ Writes the values of this process; gauges are left out of the last write, as they die with it """
+        values = {
+            metric.name: [[list(key), value] for key, value in metric.items()]
+            for metric in registry if not (isinstance(metric, Gauge) and (metric.callback or final))
+        }
+        with self._lock:
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump({'pid': os.getpid(), 'values': values}, f)
+            os.replace(f'{path}.tmp', path)
+
+    def collect(self):
+        """ Items of every metric, combined over the files of all processes """
+        self.flush(self._path.get())
+        metrics = {metric.name: metric for metric in registry}
+        series = {name: {} for name in metrics}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                logger.exception('Failed to read metrics from %s', name)
+                continue
+            alive = _alive(data['pid'])
+            for metric_name, items in data['values'].items():
+                metric = metrics.get(metric_name)
+                if metric is None:
+                    continue
+                for key, value in items:
+                    key = tuple(key)
+                    if isinstance(metric, Gauge):
+                        if alive:
+                            series[metric_name][key + (str(data['pid']),)] = value
+                    elif key in series[metric_name]:
+                        series[metric_name][key] = metric.combine(series[metric_name][key], value)
+                    else:
+                        series[metric_name][key] = value
+        return {
+            name: metric.items() if isinstance(metric, Gauge) and metric.callback else list(series[name].items())
+            for name, metric in metrics.items()
+        }
+
+    def reset(self):
+        """ Forgets the values of earlier runs; called by the servers before starting workers """
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(('.json', '.tmp')):
+                os.remove(os.path.join(self.directory, name))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = []
+shared_metrics = SharedMetrics(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+
+request_duration = Histogram('http_request_duration_seconds', 'Request latency by endpoint.',
+                             ('method', 'endpoint', 'status'))
+request_queries = Histogram('http_request_queries', 'SQL statements executed per request.',
+                            ('endpoint',), COUNT_BUCKETS)
+request_query_time = Histogram('http_request_query_seconds', 'Time spent in SQL per request.', ('endpoint',))
+query_duration = Histogram('db_query_duration_seconds', 'SQL statement latency.')
+pool_checkout_wait = Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection.')
+pool_checkout_timeouts = Counter('db_pool_checkout_timeouts_total', 'Checkouts which gave up waiting for a connection.')
+upstream_duration = Histogram('upstream_request_duration_seconds', 'Latency of calls to other services.',
+                              ('upstream', 'method', 'outcome'))
+upstream_rejections = Counter('upstream_rejections_total', 'Calls to other services refused without being made.',
+                              ('upstream', 'reason'))
+upstream_circuit_state = Gauge('upstream_circuit_state', 'Circuit breaker state: 0 closed, 1 half-open, 2 open.',
+                               ('upstream',))
+profile_cache_requests = Counter('user_profile_cache_requests_total', 'Lookups of cached user profiles.',
+                                 ('result',))
+hash_duration = Histogram('password_hash_duration_seconds', 'Password hashing latency, including queueing.',
+                          ('operation',))
+
+
+def init_app(app):
+    """ Instruments the app and exposes everything collected at /metrics in Prometheus text format """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', expose)
+
+
+def expose():
+    if shared_metrics.directory:
+        items = shared_metrics.collect()
+        text = '\n'.join(metric.expose(items[metric.name]) for metric in registry)
+    else:
+        text = '\n'.join(metric.expose() for metric in registry)
+    return Response(text + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def _endpoint():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_query_time = 0.0
+
+
+def _after_request(response):
+    if 'metrics_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    endpoint = _endpoint()
+    request_duration.observe(elapsed, method=request.method, endpoint=endpoint, status=response.status_code)
+    request_queries.observe(g.metrics_queries, endpoint=endpoint)
+    request_query_time.observe(g.metrics_query_time, endpoint=endpoint)
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        logger.warning('Slow request: %s %s took %.1f ms (%d queries, %.1f ms in SQL)', request.method,
+                       request.full_path, elapsed * 1000, g.metrics_queries, g.metrics_query_time * 1000)
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    query_duration.observe(elapsed)
+    if has_app_context() and 'metrics_queries' in g:
+        g.metrics_queries += 1
+        g.metrics_query_time += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning('Slow query (%.1f ms): %s', elapsed * 1000, statement)
@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+from db import db
+
+SCORES_DELETE = 'scores.delete'
+
+
+class OutboxMessage(db.Model):
+    """
+    Work for other services, written in the same transaction as the change which caused it and
+    delivered afterwards by the dispatcher in outbox.py. A message is deleted once delivered, or
+    kept with failed_at set once the dispatcher gives up on it.
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        # failed_at leads, so messages given up on aren't scanned when looking for due ones
+        db.Index('ix_outbox_failed_at_available_at_id', 'failed_at', 'available_at', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(50), nullable=False)
+    key = db.Column(db.String(50), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String(200))
+    failed_at = db.Column(db.DateTime)
+
+    @classmethod
+    def add(cls, topic, keys):
+        """ Adds a message per key to the current transaction; the caller commits """
+        if not keys:
+            return
+        now = datetime.now()
+        db.session.execute(cls.__table__.insert(), [
+            {'topic': topic, 'key': key, 'created_at': now, 'available_at': now, 'attempts': 0} for key in keys
+        ])
+
+    @classmethod
+    def claim(cls, limit, lease):
+        """
+        Leases up to `limit` messages which are due for delivery to the caller for `lease` seconds,
+        by moving their available_at past the lease and counting the attempt; the caller commits.
+        Messages locked by another dispatcher are skipped rather than waited for. Once committed
+        the lease holds without a lock, and a message whose dispatcher died is due again when it ends.
+        Returns the messages with the attempts made before this one.
+        """
+        now = datetime.now()
+        messages = db.session.query(cls.id, cls.topic, cls.key, cls.attempts)\
+            .filter(cls.failed_at.is_(None), cls.available_at <= now)\
+            .order_by(cls.available_at, cls.id)\
+            .with_for_update(skip_locked=True)\
+            .limit(limit).all()
+        if messages:
+            db.session.execute(
+                cls.__table__.update().where(cls.id.in_([message.id for message in messages]))
+                .values(available_at=now + timedelta(seconds=lease), attempts=cls.attempts + 1)
+            )
+        return messages
+
+    @classmethod
+    def complete(cls, ids):
+        if ids:
+            db.session.execute(cls.__table__.delete().where(cls.id.in_(ids)))
+
+    @classmethod
+    def retry_later(cls, retries, error):
+        """ Reschedules messages, `retries` being (id, delay in seconds) tuples """
+        if not retries:
+            return
+        now = datetime.now()
+        table = cls.__table__
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('message_id')).values(
+                available_at=db.bindparam('new_available_at'),
+                last_error=error[:200],
+            ),
+            [{
+                'message_id': message_id,
+                'new_available_at': now + timedelta(seconds=delay),
+            } for message_id, delay in retries],
+        )
+
+    @classmethod
+    def fail(cls, ids, error):
+        """ Gives up on delivering messages; they are kept for inspection but never claimed again """
+        if ids:
+            db.session.execute(
+                cls.__table__.update().where(cls.id.in_(ids)).values(failed_at=datetime.now(), last_error=error[:200])
+            )
+
+    @classmethod
+    def backlog(cls):
+        """ Number of messages still to be delivered and the creation time of the oldest one """
+        return db.session.query(db.func.count(cls.id), db.func.min(cls.created_at))\
+            .filter(cls.failed_at.is_(None)).one()
+
+    @classmethod
+    def failed(cls):
+        """ Number of messages given up on """
+        return db.session.query(db.func.count(cls.id)).filter(cls.failed_at.isnot(None)).scalar()
@@ -0,0 +1,34 @@
+from datetime import datetime
+
+from db import db, insert_ignoring_conflicts
+
+
+class RevokedToken(db.Model):
+    """
+    Access tokens revoked before they expire. Every process verifying tokens locally loads the
+    revocations made since its previous load periodically (see tokens.py), so a logout is honoured
+    by all of them.
+    """
+    __tablename__ = 'revoked_tokens'
+
+    key = db.Column(db.String(255), primary_key=True)
+    revoked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def add(cls, key, expires_at):
+        insert_ignoring_conflicts(cls.__table__, [{'key': key, 'revoked_at': datetime.utcnow(), 'expires_at': expires_at}])
+        db.session.commit()
+
+    @classmethod
+    def find_active(cls, revoked_since=None):
+        """ (key, expires_at) of the revoked tokens which haven't expired yet, made since `revoked_since` if given """
+        query = db.session.query(cls.key, cls.expires_at).filter(cls.expires_at > datetime.utcnow())
+        if revoked_since:
+            query = query.filter(cls.revoked_at >= revoked_since)
+        return query.all()
+
+    @classmethod
+    def delete_expired(cls):
+        db.session.execute(cls.__table__.delete().where(cls.expires_at <= datetime.utcnow()))
+        db.session.commit()
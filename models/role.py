@@ -1,9 +1,20 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
 from db import db
 
 
 class Role(db.Model):
     __tablename__ = 'roles'
 
+    CACHE_TTL = int(os.environ.get('ROLE_CACHE_TTL', 300))
+    _cache = None
+    _cache_expires = 0
+    _cache_lock = threading.Lock()
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(10), nullable=False, unique=True)
 
@@ -14,6 +25,37 @@ class Role(db.Model):
     def find_by_id(cls, _id):
         return cls.query.filter_by(id=_id).first()
 
+    @classmethod
+    def names(cls):
+        """
+        Process-wide {id: name} map of the roles table. It's tiny and hardly ever changes, so it's
+        loaded once, dropped whenever a role is written through the ORM, and reloaded after CACHE_TTL
+        seconds to pick up changes made by other processes.
+        """
+        cache = cls._cache
+        if cache is None or cls._cache_expires <= time.monotonic():
+            with cls._cache_lock:
+                cache = {role_id: name for role_id, name in db.session.query(cls.id, cls.name)}
+                cls._cache = cache
+                cls._cache_expires = time.monotonic() + cls.CACHE_TTL
+        return cache
+
+    @classmethod
+    def name_of(cls, role_id):
+        return cls.names().get(role_id)
+
+    @classmethod
+    def id_of(cls, name):
+        return next((role_id for role_id, role_name in cls.names().items() if role_name == name), None)
+
+    @classmethod
+    def invalidate_cache(cls, *args):
+        cls._cache = None
+
     def save_to_db(self):
         db.session.add(self)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Role, _event, Role.invalidate_cache)
@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from db import db
+
+
+class UserTombstone(db.Model):
+    """ Marks a deleted user, so the change feed can report deletions """
+    __tablename__ = 'user_tombstones'
+    __table_args__ = (
+        db.Index('ix_user_tombstones_deleted_at_user_id', 'deleted_at', 'user_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(22), nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    @classmethod
+    def record(cls, user_ids):
+        """ Adds tombstones for the given users to the current transaction; the caller commits """
+        if not user_ids:
+            return
+        deleted_at = datetime.now()
+        db.session.execute(cls.__table__.insert(), [
+            {'user_id': user_id, 'deleted_at': deleted_at} for user_id in user_ids
+        ])
+
+    @classmethod
+    def find_page(cls, limit, after=None, until=None):
+        """ Keyset pagination over (deleted_at, user_id), optionally only up to `until` """
+        query = db.session.query(cls.user_id, cls.deleted_at).order_by(cls.deleted_at, cls.user_id)
+        if after:
+            query = query.filter(db.tuple_(cls.deleted_at, cls.user_id) > after)
+        if until:
+            query = query.filter(cls.deleted_at <= until)
+        return query.limit(limit).all()
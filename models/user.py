@@ -1,21 +1,49 @@
-from werkzeug.security import generate_password_hash
-from datetime import datetime
+import os
+import re
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 from shortuuid import uuid
+from sqlalchemy import DDL, event, inspect
+from sqlalchemy.exc import IntegrityError
 
+from cache import TTLCache
 from db import db
+from hashing import hasher
+from metrics import profile_cache_requests
+from models.outbox import OutboxMessage, SCORES_DELETE
+from models.role import Role
+from models.tombstone import UserTombstone
+
+
+EMAIL_RE = re.compile(r'[^@\s\'\"]{1,64}@[a-z0-9\-]*\.[a-z0-9]*')
 
 
 class UserModel(db.Model):
     VALID_LANGS = "EN", "PL"
+    PUBLIC_FIELDS = 'id', 'role_id', 'username', 'email', 'language', 'registration_date'
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_users_registration_date_id', 'registration_date', 'id'),
+        db.Index('ix_users_updated_at_id', 'updated_at', 'id'),
+    )
+    # profiles are cached per process; writes through the model invalidate them in the process
+    # which made them, other processes may serve the old profile for up to PROFILE_CACHE_TTL seconds
+    PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', 10))
+    profile_cache = TTLCache(int(os.environ.get('PROFILE_CACHE_SIZE', 10000)), PROFILE_CACHE_TTL)
+    SEARCH_FIELDS = {'username': ('username',), 'email': ('email',), 'any': ('username', 'email')}
 
     id = db.Column(db.String(22), primary_key=True, autoincrement=False, default=uuid)
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'), nullable=False, default=2)
     username = db.Column(db.String(30), nullable=False, unique=True)
-    password = db.Column(db.String(100), nullable=False)
+    password = db.Column(db.String(255), nullable=False)
     registration_date = db.Column(db.DateTime, default=datetime.now)
     email = db.Column(db.String(100), nullable=False, unique=True)
+    email_domain = db.Column(db.String(100), index=True)
     language = db.Column(db.String(2), nullable=False, default="EN")
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+    role = db.relationship(Role, lazy='joined', innerjoin=True)
 
     def __init__(self, username, password, email, language=None, role_id=None, user_id=None):
         if role_id:
@@ -25,22 +53,40 @@ class UserModel(db.Model):
         if language and language in UserModel.VALID_LANGS:
             self.language = language
         self.email = email
+        self.email_domain = UserModel.domain_of(email)
         self.username = username
-        self.password = generate_password_hash(password)
+        self.password = hasher.hash(password)
 
     def json(self):
+        return UserModel.serialize(self)
+
+    @staticmethod
+    def serialize(row, fields=PUBLIC_FIELDS):
+        """ Builds the public dict of a user from a model or from a projected row having `fields` """
         return {
-            'id': self.id,
-            'role_id': self.role_id,
-            'username': self.username,
-            'email': self.email,
-            'language': self.language,
-            'registration_date': str(self.registration_date)[:19]
+            field: str(row.registration_date)[:19] if field == 'registration_date' else getattr(row, field)
+            for field in fields
         }
 
+    @staticmethod
+    def domain_of(email):
+        """ Domain part of an email, stored on its own so domain lookups can use an index """
+        return email.rpartition('@')[2].lower()
+
+    def etag(self):
+        return UserModel.make_etag(self.id, self.version)
+
+    @staticmethod
+    def make_etag(user_id, version):
+        return f'{user_id}.{version}'
+
     def delete_from_db(self):
+        user_id = self.id
         db.session.delete(self)
+        UserTombstone.record([user_id])
+        OutboxMessage.add(SCORES_DELETE, [user_id])
         db.session.commit()
+        UserModel.profile_cache.pop(user_id)
 
     @classmethod
     def find_by_username(cls, username):
@@ -54,10 +100,337 @@ class UserModel(db.Model):
     def find_by_id(cls, _id):
         return cls.query.filter_by(id=_id).first()
 
+    @classmethod
+    def find_profile(cls, _id):
+        """ (public profile, version) of a user or None, served from the profile cache """
+        cached = cls.profile_cache.get(_id)
+        profile_cache_requests.inc(result='hit' if cached else 'miss')
+        if not cached:
+            cached = cls.profile_cache.get_or_load(_id, lambda: cls._load_profile(_id))
+        return cached and (dict(cached[0]), cached[1])
+
+    @classmethod
+    def _load_profile(cls, _id):
+        row = cls.project(cls.PUBLIC_FIELDS, 'version').filter(cls.id == _id).first()
+        return row and (cls.serialize(row), row.version)
+
+    @classmethod
+    def find_taken(cls, username=None, email=None):
+        """ Which of the given names are in use, compared case-insensitively, using a single query """
+        username, email = username and username.lower(), email and email.lower()
+        lowered_username, lowered_email = db.func.lower(cls.username), db.func.lower(cls.email)
+        criteria = []
+        if username:
+            criteria.append(lowered_username == username)
+        if email:
+            criteria.append(lowered_email == email)
+
+        taken = set()
+        for row_username, row_email in db.session.query(lowered_username, lowered_email)\
+                .filter(db.or_(*criteria)).limit(2):
+            if username and row_username == username:
+                taken.add('username')
+            if email and row_email == email:
+                taken.add('email')
+        return taken
+
     @classmethod
     def find_all(cls):
         return cls.query.all()
 
+    @classmethod
+    def project(cls, fields, *extra):
+        """
+        Query for plain read-only rows with just the given columns. Rows skip the identity map
+        and the per-object state of full models, which is most of the cost of listing users.
+        """
+        names = list(fields) + [name for name in extra if name not in fields]
+        return db.session.query(*(getattr(cls, name) for name in names))
+
+    @classmethod
+    def find_all_rows(cls, fields=PUBLIC_FIELDS):
+        return cls.project(fields).all()
+
+    @classmethod
+    def find_page(cls, limit, after=None, fields=PUBLIC_FIELDS, criteria=()):
+        """ Keyset pagination over (registration_date, id); `after` is the last key of the previous page """
+        query = cls.project(fields, 'registration_date', 'id').filter(*criteria)\
+            .order_by(cls.registration_date, cls.id)
+        if after:
+            query = query.filter(db.tuple_(cls.registration_date, cls.id) > after)
+        return query.limit(limit).all()
+
+    @classmethod
+    def find_many(cls, ids, fields=PUBLIC_FIELDS):
+        """ Rows of the users with the given ids, fetched with a single IN query """
+        return cls.project(fields, 'id').filter(cls.id.in_(ids)).all()
+
+    @classmethod
+    def search_criteria(cls, text=None, field='username', match='prefix', domain=None, language=None,
+                        role_id=None, registered_after=None, registered_before=None):
+        """
+        Filters for find_page. `text` is matched case-insensitively against the lowercased columns
+        of `field` ('username', 'email' or 'any'), either as a prefix or, with match='contains',
+        anywhere in the value. Both are served by the lower() indexes defined below the model.
+        """
+        criteria = []
+        if text:
+            columns = [db.func.lower(getattr(cls, name)) for name in cls.SEARCH_FIELDS[field]]
+            if match == 'contains':
+                matches = [column.contains(text.lower(), autoescape=True) for column in columns]
+            else:
+                matches = [column.startswith(text.lower(), autoescape=True) for column in columns]
+            criteria.append(db.or_(*matches))
+        if domain:
+            criteria.append(cls.email_domain == domain.lower())
+        if language:
+            criteria.append(cls.language == language)
+        if role_id:
+            criteria.append(cls.role_id == role_id)
+        if registered_after:
+            criteria.append(cls.registration_date >= registered_after)
+        if registered_before:
+            criteria.append(cls.registration_date < registered_before)
+        return criteria
+
+    @classmethod
+    def find_changed(cls, limit, after=None, until=None, fields=PUBLIC_FIELDS):
+        """ Keyset pagination over (updated_at, id), optionally only up to `until` """
+        query = cls.project(fields, 'registration_date', 'updated_at', 'id').order_by(cls.updated_at, cls.id)
+        if after:
+            query = query.filter(db.tuple_(cls.updated_at, cls.id) > after)
+        if until:
+            query = query.filter(cls.updated_at <= until)
+        return query.limit(limit).all()
+
+    @classmethod
+    def iter_all(cls, fields=PUBLIC_FIELDS, batch_size=500):
+        """ Yields rows from a server-side cursor, holding at most `batch_size` of them in memory """
+        return cls.project(fields).order_by(cls.registration_date, cls.id)\
+            .execution_options(stream_results=True)\
+            .yield_per(batch_size)
+
+    @classmethod
+    def bulk_create(cls, users, batch_size=1000):
+        """
+        Creates many users in a single transaction, using multi-row inserts of `batch_size` rows.
+
+        `users` is a list of dicts with the UserModel constructor arguments. Passwords are hashed in
+        parallel on the hashing pool. Rows which are invalid or clash with an existing user (or an earlier
+        row) are skipped and reported, the rest is inserted. Returns the created ids and the row errors.
+        """
+        created, errors, valid = [], [], []
+        usernames, emails, ids = set(), set(), set()
+
+        for index, user in enumerate(users):
+            error = cls._row_error(user)
+            if error:
+                errors.append({'index': index, 'message': error})
+            elif user['username'].lower() in usernames:
+                errors.append({'index': index, 'message': 'Username taken.'})
+            elif user['email'].lower() in emails:
+                errors.append({'index': index, 'message': 'User already registered with this email.'})
+            elif user.get('user_id') and user['user_id'] in ids:
+                errors.append({'index': index, 'message': 'User id taken.'})
+            else:
+                usernames.add(user['username'].lower())
+                emails.add(user['email'].lower())
+                if user.get('user_id'):
+                    ids.add(user['user_id'])
+                valid.append((index, user))
+
+        hashes = hasher.hash_many(user['password'] for _, user in valid)
+
+        try:
+            for start in range(0, len(valid), batch_size):
+                batch = valid[start:start + batch_size]
+                taken_usernames, taken_emails, taken_ids = cls._taken([user for _, user in batch])
+                rows = []
+                for (index, user), password in zip(batch, hashes[start:start + batch_size]):
+                    if user['username'].lower() in taken_usernames:
+                        errors.append({'index': index, 'message': 'Username taken.'})
+                    elif user['email'].lower() in taken_emails:
+                        errors.append({'index': index, 'message': 'User already registered with this email.'})
+                    elif user.get('user_id') in taken_ids:
+                        errors.append({'index': index, 'message': 'User id taken.'})
+                    else:
+                        rows.append(cls.bulk_row(user, password))
+                if rows:
+                    db.session.execute(cls.__table__.insert(), rows)
+                    created.extend(row['id'] for row in rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        errors.sort(key=lambda error: error['index'])
+        return created, errors
+
+    @classmethod
+    def _row_error(cls, user):
+        """ Why a bulk_create row can't be inserted, or None """
+        if not isinstance(user, dict):
+            return 'Each user must be an object.'
+        if not all(user.get(field) for field in ('username', 'password', 'email')):
+            return 'Required arguments missing.'
+        if not all(isinstance(user[field], str) for field in ('username', 'password', 'email')):
+            return 'Username, password and email must be strings.'
+        if len(user['username']) > cls.username.type.length:
+            return 'Username too long.'
+        if len(user['email']) > cls.email.type.length or not EMAIL_RE.fullmatch(user['email']):
+            return 'Invalid email address.'
+        role_id = user.get('role_id')
+        if role_id is not None and (type(role_id) is not int or Role.name_of(role_id) is None):
+            return 'Unknown role.'
+        if user.get('user_id') is not None and not (isinstance(user['user_id'], str) and
+                                                    0 < len(user['user_id']) <= cls.id.type.length):
+            return 'Invalid user id.'
+        return None
+
+    @classmethod
+    def _taken(cls, users):
+        """ Returns the lowercased usernames and emails, and the ids, of `users` which are already registered """
+        username, email = db.func.lower(cls.username), db.func.lower(cls.email)
+        rows = db.session.query(username, email, cls.id).filter(db.or_(
+            username.in_([user['username'].lower() for user in users]),
+            email.in_([user['email'].lower() for user in users]),
+            cls.id.in_([user['user_id'] for user in users if user.get('user_id')]),
+        )).all()
+        return {row[0] for row in rows}, {row[1] for row in rows}, {row[2] for row in rows}
+
+    @classmethod
+    def register(cls, username, password, email, language=None):
+        """
+        Creates a user with a single INSERT, relying on the unique indexes rather than looking for
+        clashes first, so concurrent registrations can't race. Returns the public profile of the new
+        user and None, or None and the field ('username' or 'email') which is already taken.
+        """
+        row = cls.bulk_row({'username': username, 'email': email, 'language': language}, hasher.hash(password))
+        try:
+            db.session.execute(cls.__table__.insert(), row)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            field = cls._conflicting_field(e)
+            if field is None:
+                raise
+            return None, field
+        return cls.serialize(SimpleNamespace(**row)), None
+
+    @staticmethod
+    def _conflicting_field(error):
+        # the violated constraint is named by psycopg2; other drivers only mention it in the message
+        diag = getattr(error.orig, 'diag', None)
+        text = (getattr(diag, 'constraint_name', None) or str(error.orig)).lower()
+        for field in ('email', 'username'):
+            if field in text:
+                return field
+        return None
+
+    @classmethod
+    def bulk_row(cls, user, password):
+        language = user.get('language')
+        now = datetime.now()
+        return {
+            'id': user.get('user_id') or uuid(),
+            'role_id': user.get('role_id') or 2,
+            'username': user['username'],
+            'password': password,
+            'registration_date': now,
+            'updated_at': now,
+            'email': user['email'],
+            'email_domain': cls.domain_of(user['email']),
+            'language': language if language in cls.VALID_LANGS else 'EN',
+        }
+
+    @classmethod
+    def delete_where(cls, *criteria, chunk_size=1000):
+        """
+        Deletes users matching `criteria` with set-based DELETE statements of at most `chunk_size` rows,
+        committing after each chunk so locks are not held for the whole operation. Every chunk
+        queues the deletion of the users' scores in the outbox. Yields the deleted (id, username) rows of every chunk.
+        """
+        while True:
+            chunk = db.session.query(cls.id).filter(*criteria).limit(chunk_size).subquery()
+            statement = cls.__table__.delete().where(cls.id.in_(db.select([chunk.c.id])))
+
+            if db.engine.dialect.name == 'postgresql':
+                rows = db.session.execute(statement.returning(cls.id, cls.username)).fetchall()
+            else:
+                rows = db.session.query(cls.id, cls.username).filter(*criteria).limit(chunk_size).all()
+                if rows:
+                    db.session.execute(cls.__table__.delete().where(cls.id.in_([row.id for row in rows])))
+            if rows:
+                UserTombstone.record([row.id for row in rows])
+                OutboxMessage.add(SCORES_DELETE, [row.id for row in rows])
+            db.session.commit()
+            for row in rows:
+                cls.profile_cache.pop(row.id)
+
+            if not rows:
+                return
+            yield rows
+
+    @classmethod
+    def count_where(cls, *criteria):
+        return db.session.query(db.func.count(cls.id)).filter(*criteria).scalar()
+
+    @classmethod
+    def version_of(cls, _id):
+        return db.session.query(cls.version).filter_by(id=_id).scalar()
+
+    @classmethod
+    def last_changes(cls):
+        """ Statement selecting when a user was last written ('changed') and last deleted ('deleted') """
+        return db.select([
+            db.select([db.func.max(cls.updated_at)]).scalar_subquery().label('changed'),
+            db.select([db.func.max(UserTombstone.deleted_at)]).scalar_subquery().label('deleted'),
+        ])
+
+    @classmethod
+    def list_version(cls, settle_seconds=0):
+        """
+        Changes whenever any user is created, updated or deleted, read from the indexed change times
+        rather than kept in a row every write would have to lock. While the latest change is younger
+        than `settle_seconds` this is None: a write which took its time to commit could still show up
+        with an earlier change time, so the list can't be tagged yet.
+        """
+        row = db.session.execute(cls.last_changes()).one()
+        return cls.make_list_version(row.changed, row.deleted, settle_seconds)
+
+    @staticmethod
+    def make_list_version(changed, deleted, settle_seconds=0):
+        latest = max((value for value in (changed, deleted) if value), default=None)
+        if latest and latest > datetime.now() - timedelta(seconds=settle_seconds):
+            return None
+        return '-'.join(value.strftime('%Y%m%d%H%M%S%f') if value else '0' for value in (changed, deleted))
+
     def save_to_db(self):
+        updated = inspect(self).persistent
+        if updated:
+            self.version = UserModel.version + 1
         db.session.add(self)
         db.session.commit()
+        if updated:
+            # the identity doesn't need the expired instance to be reloaded
+            UserModel.profile_cache.pop(inspect(self).identity[0])
+
+
+# Case-insensitive unique indexes, which also serve search. They use text_pattern_ops on Postgres
+# so they serve LIKE 'prefix%' regardless of the collation; substring search needs the trigram ones,
+# which only exist on Postgres (pg_trgm is created together with the tables).
+# Existing databases get all of them from bootstrap.migrate.
+POSTGRES_INDEXES = {}
+for _name in ('username', 'email'):
+    _lowered = db.func.lower(getattr(UserModel, _name)).label(f'{_name}_lower')
+    db.Index(f'ix_users_{_name}_lower', _lowered, unique=True,
+             postgresql_ops={f'{_name}_lower': 'text_pattern_ops'})
+    POSTGRES_INDEXES[f'ix_users_{_name}_trgm'] = f'ON users USING gin (lower({_name}) gin_trgm_ops)'
+
+for _index, _definition in POSTGRES_INDEXES.items():
+    event.listen(UserModel.__table__, 'after_create', DDL(
+        f'CREATE INDEX IF NOT EXISTS {_index} {_definition}'
+    ).execute_if(dialect='postgresql'))
+
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
@@ -0,0 +1,131 @@
+"""
+Delivery of outbox messages (see models/outbox.py) to other services.
+
+Tuned through environment variables:
+    OUTBOX_BATCH_SIZE   messages delivered per round (500)
+    OUTBOX_INTERVAL     seconds between polls while the outbox is empty (1)
+    OUTBOX_BACKOFF      delay before the first retry of a failed delivery, doubled per attempt (1)
+    OUTBOX_MAX_BACKOFF  upper bound of the retry delay (300)
+    OUTBOX_MAX_ATTEMPTS deliveries tried before a message is given up on and marked failed (20)
+    OUTBOX_LEASE        seconds a dispatcher has to deliver the messages it claimed (60)
+
+Messages are claimed with a lease which is committed before delivery, so no row lock is held
+while the other service is called; a dispatcher which dies mid-delivery leaves its messages to be
+claimed again once the lease runs out. Failed messages stay in the outbox, see /admin/outbox.
+
+Deliveries are idempotent, a message may be delivered more than once (e.g. when a worker dies
+between the delivery and its commit, or a delivery outlasts its lease), but it is only removed
+after a successful one.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from db import db
+from metrics import Gauge
+from models.outbox import OutboxMessage, SCORES_DELETE
+from process_local import PerProcess
+from upstream import score_service, UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+def delete_scores(user_ids):
+    """ Deletes scores of the given users, returns the ids whose scores couldn't be deleted """
+    try:
+        resp = score_service.delete('/scores', json={'user_ids': user_ids})
+    except UpstreamUnavailable:
+        return user_ids
+    return [] if resp.status_code == 200 else user_ids
+
+
+class Dispatcher:
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.batch_size = int(os.environ.get('OUTBOX_BATCH_SIZE', 500))
+        self.interval = float(os.environ.get('OUTBOX_INTERVAL', 1))
+        self.backoff = float(os.environ.get('OUTBOX_BACKOFF', 1))
+        self.max_backoff = float(os.environ.get('OUTBOX_MAX_BACKOFF', 300))
+        self.max_attempts = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 20))
+        self.lease = float(os.environ.get('OUTBOX_LEASE', 60))
+        self._thread = PerProcess(self._start)
+
+    def dispatch_once(self):
+        """ Delivers one batch of due messages and commits; returns the number of messages handled """
+        try:
+            messages = OutboxMessage.claim(self.batch_size, self.lease)
+            db.session.commit()
+            by_topic = defaultdict(list)
+            for message in messages:
+                by_topic[message.topic].append(message)
+
+            for topic, batch in by_topic.items():
+                failed = set(self.handlers[topic](list(dict.fromkeys(message.key for message in batch))))
+                OutboxMessage.complete([message.id for message in batch if message.key not in failed])
+                # message.attempts doesn't count this one yet
+                retries = [message for message in batch if message.key in failed]
+                given_up = [message.id for message in retries if message.attempts + 1 >= self.max_attempts]
+                if given_up:
+                    logger.error('Giving up on %d %s messages after %d attempts', len(given_up), topic, self.max_attempts)
+                OutboxMessage.fail(given_up, f'{topic} delivery failed')
+                OutboxMessage.retry_later([
+                    (message.id, self.retry_delay(message.attempts))
+                    for message in retries if message.attempts + 1 < self.max_attempts
+                ], f'{topic} delivery failed')
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return len(messages)
+
+    def retry_delay(self, attempts):
+        # exponential backoff with jitter, so a recovering service isn't hit by every message at once
+        return min(self.max_backoff, self.backoff * 2 ** attempts) * random.uniform(0.5, 1)
+
+    def ensure_running(self, app):
+        self._thread.get(app)
+
+    def _start(self, app):
+        thread = threading.Thread(target=self._run, args=(app,), name='outbox-dispatch', daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self, app):
+        with app.app_context():
+            while True:
+                try:
+                    handled = self.dispatch_once()
+                except Exception:
+                    logger.exception('Outbox dispatch failed')
+                    handled = 0
+                finally:
+                    db.session.remove()
+                if handled < self.batch_size:
+                    time.sleep(self.interval)
+
+
+dispatcher = Dispatcher({SCORES_DELETE: delete_scores})
+
+
+def backlog():
+    count, oldest = OutboxMessage.backlog()
+    return {
+        'backlog': count,
+        'oldest_age_s': round((datetime.now() - oldest).total_seconds(), 3) if oldest else 0,
+        'failed': OutboxMessage.failed(),
+    }
+
+
+backlog_size = Gauge('outbox_backlog', 'Undelivered outbox messages.', callback=lambda: backlog()['backlog'])
+failed_size = Gauge('outbox_failed', 'Outbox messages given up on after OUTBOX_MAX_ATTEMPTS.',
+                    callback=OutboxMessage.failed)
+
+
+def init_app(app):
+    """ Runs the dispatcher in every process serving the app, unless OUTBOX_DISPATCH is off """
+    if app.config.get('OUTBOX_DISPATCH', True):
+        app.before_request(lambda: dispatcher.ensure_running(app))
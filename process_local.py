@@ -0,0 +1,25 @@
+import os
+import threading
+
+
+class PerProcess:
+    """
+    Value created on first use in every process. Connections, pools, locks and threads are not
+    carried over a fork, so each worker process must make its own rather than inherit the master's.
+
+    `get(*args)` returns this process's value, calling `factory(*args)` the first time. If the
+    factory raises, the next call tries again.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self, *args):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self.factory(*args)
+                    self._pid = os.getpid()
+        return self._value
@@ -0,0 +1,37 @@
+from flask_restful import Resource
+
+import outbox
+from db import db
+from resources.user import User
+from utils import login_required
+
+
+class PoolStats(Resource):
+    @classmethod
+    @login_required
+    def get(cls):
+        if User.get_claims() != 'ADMIN':
+            return {
+                'message': 'Admin privileges required.'
+            }, 401
+
+        pool = db.engine.pool
+        return {
+            'message': 'Success.',
+            'content': pool.stats() if hasattr(pool, 'stats') else {'status': pool.status()},
+        }
+
+
+class OutboxStats(Resource):
+    @classmethod
+    @login_required
+    def get(cls):
+        if User.get_claims() != 'ADMIN':
+            return {
+                'message': 'Admin privileges required.'
+            }, 401
+
+        return {
+            'message': 'Success.',
+            'content': outbox.backlog(),
+        }
@@ -1,14 +1,23 @@
-import re
-import requests
-import os
+import hashlib
+import json
+from datetime import datetime, timedelta
 
-from flask import session
-from flask_restful import Resource, reqparse
-from werkzeug.security import check_password_hash, generate_password_hash
+from flask import session, g, request, current_app, Response, stream_with_context
+from flask_restful import Resource, reqparse, inputs
 
-from models.user import UserModel
-from models.role import Role
-from utils import login_required
+from availability import taken_names
+from models.tombstone import UserTombstone
+from models.user import UserModel, EMAIL_RE
+from hashing import hasher
+from tokens import get_verifier
+from upstream import token_service
+from utils import login_required, encode_cursor, decode_cursor, parse_datetime, etag_matches, not_modified,\
+    etag_header
+
+CONFLICT_MESSAGES = {
+    'email': 'User already registered with this email.',
+    'username': 'Username taken.',
+}
 
 
 class Me(Resource):
@@ -38,12 +47,12 @@ class Me(Resource):
             user = UserModel.find_by_id(response['user_id'])
 
             if all((data['old_password'], data['password1'], data['password2'])):
-                if not check_password_hash(user.password, data['old_password']) or\
+                if not hasher.check(user.password, data['old_password']) or\
                    data['password1'] != data['password2']:
                     return {
                         'message': 'Passwords do not match.'
                     }, 401
-                user.password = generate_password_hash(data['password1'])
+                user.password = hasher.hash(data['password1'])
                 user.save_to_db()
 
                 return {
@@ -70,17 +79,16 @@ class Me(Resource):
     def delete(cls):
         response = Me.get_id()
         if 'user_id' in response:
-            resp = requests.delete(f"{os.environ['SCORE_SERVICE']}/scores/{response['user_id']}")
-            if resp.status_code != 200:
+            # the user's scores are deleted in the background, see outbox.py
+            deleted = [row for rows in UserModel.delete_where(UserModel.id == response['user_id']) for row in rows]
+            if not deleted:
                 return {
-                    'message': 'Couldn\'t delete the user scores, please, try again.'
-                }, resp.status_code
+                    'message': 'No such user.'
+                }, 400
 
-            user = UserModel.find_by_id(response['user_id'])
-            user.delete_from_db()
             UserLogout.get()
             return {
-                'message': f'Successfully deleted user {user.username} ({response["user_id"]}).'
+                'message': f'Successfully deleted user {deleted[0].username} ({response["user_id"]}).'
             }
 
         return {
@@ -90,22 +98,29 @@ class Me(Resource):
 
     @classmethod
     def get_id(cls):
-        return requests.get(url=f'{os.environ["TOKEN_SERVICE"]}/user_id',
-                            headers={'Authorization': f'Bearer {session["access_token"]}'}).json()
+        if 'token_claims' in g:
+            return {'user_id': g.token_claims['user_id']}
+        return token_service.get('/user_id',
+                                 headers={'Authorization': f'Bearer {session["access_token"]}'}).json()
 
 
 class User(Resource):
     @classmethod
     def get(cls, user_id):
-        user = UserModel.find_by_id(user_id)
+        cached = UserModel.find_profile(user_id)
 
-        if not user:
+        if not cached:
             return {'message': 'User not found'}, 404
 
+        profile, version = cached
+        etag = UserModel.make_etag(user_id, version)
+        if etag_matches(etag):
+            return not_modified(etag)
+
         return {
             'message': 'Success',
-            'content': user.json()
-        }
+            'content': profile
+        }, 200, etag_header(etag)
 
     @classmethod
     @login_required
@@ -115,50 +130,275 @@ class User(Resource):
                 'message': f'Admin privileges required.'
             }, 401
 
-        resp = requests.delete(f"{os.environ['SCORE_SERVICE']}/scores/{user_id}")
-        if resp.status_code != 200:
-            return {
-                'message': 'Couldn\'t delete the user scores, please, try again.'
-            }, resp.status_code
-
-        user = UserModel.find_by_id(user_id)
+        deleted = [row for rows in UserModel.delete_where(UserModel.id == user_id) for row in rows]
 
-        if not user:
+        if not deleted:
             return {
                 'message': 'No such user.'
             }, 400
 
-        user.delete_from_db()
-
         return {
-            'message': f'User {user.username} ({user.id}) successfully deleted.'
+            'message': f'User {deleted[0].username} ({deleted[0].id}) successfully deleted.'
         }
 
     @classmethod
     def get_claims(cls):
-        claims = requests.get(url=f'{os.environ["TOKEN_SERVICE"]}/user_role',
-                              headers={'Authorization': f'Bearer {session["access_token"]}'}).json()
+        if 'token_claims' in g:
+            return g.token_claims['user_role']
+        claims = token_service.get('/user_role',
+                                   headers={'Authorization': f'Bearer {session["access_token"]}'}).json()
         return claims['user_role']
 
 
 class UserList(Resource):
+    PAGE_MAX = 1000
+    NON_ADMIN_MESSAGE = 'Success. Get admin privileges for more detailed info.'
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit', type=int, location='args')
+    parser.add_argument('after', type=str, location='args')
+    parser.add_argument('stream', type=str, location='args', choices=('ndjson', 'json'),
+                        help="Streaming format must be either 'ndjson' or 'json'.")
+
     @classmethod
     @login_required
     def get(cls):
-        users = [user.json() for user in UserModel.find_all()]
+        data = UserList.parser.parse_args()
+        is_admin = User.get_claims() == 'ADMIN'
+
+        if data['stream']:
+            return cls.stream(data['stream'], is_admin)
+
+        etag = cls.etag(is_admin)
+        if etag_matches(etag):
+            return not_modified(etag)
+
+        if data['limit'] is not None or data['after']:
+            return cls.get_page(data['limit'], data['after'], is_admin, etag)
+
+        if not is_admin:
+            return {
+                'message': cls.NON_ADMIN_MESSAGE,
+                'content': [row.username for row in UserModel.find_all_rows(('username',))],
+            }, 200, etag_header(etag)
+
+        return {
+            'message': 'Success.',
+            'content': [UserModel.serialize(row) for row in UserModel.find_all_rows()],
+        }, 200, etag_header(etag)
+
+    @classmethod
+    def etag(cls, is_admin):
+        """ Tag of the listing as seen by the caller, or None while it can't be tagged yet """
+        version = UserModel.list_version(current_app.config.get('CHANGES_SETTLE_SECONDS', 0))
+        return cls.make_etag(version, is_admin, request.query_string)
+
+    @staticmethod
+    def make_etag(version, is_admin, query_string):
+        if version is None:
+            return None
+        query = hashlib.sha1(query_string).hexdigest()[:12]
+        return f'users.{version}.{"admin" if is_admin else "user"}.{query}'
+
+    @classmethod
+    def get_page(cls, limit, cursor, is_admin, etag):
+        limit = cls.PAGE_MAX if limit is None else min(limit, cls.PAGE_MAX)
+        if limit < 1:
+            return {'message': 'Limit must be a positive number.'}, 400
+
+        after = None
+        if cursor:
+            try:
+                registration_date, user_id = decode_cursor(cursor, 2)
+                after = parse_datetime(registration_date), user_id
+            except ValueError:
+                return {'message': 'Invalid cursor.'}, 400
+
+        rows = UserModel.find_page(limit, after, UserModel.PUBLIC_FIELDS if is_admin else ('username',))
+        next_cursor = encode_cursor(rows[-1].registration_date, rows[-1].id) if len(rows) == limit else None
+
+        return {
+            'message': 'Success.' if is_admin else cls.NON_ADMIN_MESSAGE,
+            'content': [UserModel.serialize(row) if is_admin else row.username for row in rows],
+            'next': next_cursor,
+        }, 200, etag_header(etag)
+
+    @classmethod
+    def stream(cls, fmt, is_admin):
+        """
+        Streams the whole user list from a server-side cursor, so memory use doesn't grow with the table.
+        'ndjson' writes one user per line, 'json' writes the usual response body as a chunked array.
+        """
+        message = 'Success.' if is_admin else cls.NON_ADMIN_MESSAGE
+
+        def items():
+            if is_admin:
+                for row in UserModel.iter_all():
+                    yield json.dumps(UserModel.serialize(row))
+            else:
+                for row in UserModel.iter_all(('username',)):
+                    yield json.dumps(row.username)
 
-        # import time
-        # time.sleep(2)
+        def ndjson():
+            for item in items():
+                yield item + '\n'
 
+        def chunked_json():
+            yield '{"message": %s, "content": [' % json.dumps(message)
+            for i, item in enumerate(items()):
+                yield item if i == 0 else ', ' + item
+            yield ']}\n'
+
+        if fmt == 'ndjson':
+            return Response(stream_with_context(ndjson()), mimetype='application/x-ndjson')
+        return Response(stream_with_context(chunked_json()), mimetype='application/json')
+
+
+class UserBatch(Resource):
+    MAX_IDS = 5000
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('ids', type=str, action='append', location='json', required=True,
+                        help="Please provide a list of user ids.")
+    parser.add_argument('fields', type=str, action='append', location='json')
+
+    @classmethod
+    def post(cls):
+        data = UserBatch.parser.parse_args()
+        ids = list(dict.fromkeys(data['ids']))
+        fields = data['fields'] or UserModel.PUBLIC_FIELDS
+
+        if len(ids) > cls.MAX_IDS:
+            return {'message': f'At most {cls.MAX_IDS} users can be looked up at once.'}, 400
+        unknown = [field for field in fields if field not in UserModel.PUBLIC_FIELDS]
+        if unknown:
+            return {'message': f'Unknown fields: {", ".join(unknown)}.'}, 400
+
+        users = {row.id: UserModel.serialize(row, fields) for row in UserModel.find_many(ids, fields)}
+
+        return {
+            'message': 'Success.',
+            'content': {
+                'users': users,
+                'missing': [user_id for user_id in ids if user_id not in users],
+            },
+        }
+
+
+class UserChanges(Resource):
+    """
+    Feed of user inserts, updates and deletions ordered by (time, id), for keeping downstream
+    copies in sync. Every response carries the cursor to resume from with `since`.
+    """
+    PAGE_MAX = 1000
+    PAGE_DEFAULT = 500
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('since', type=str, location='args')
+    parser.add_argument('limit', type=int, location='args')
+
+    @classmethod
+    @login_required
+    def get(cls):
         if User.get_claims() != 'ADMIN':
             return {
-                'message': 'Success. Get admin privileges for more detailed info.',
-                'content': [user['username'] for user in users],
-            }
+                'message': 'Admin privileges required.'
+            }, 401
+
+        data = UserChanges.parser.parse_args()
+        limit = cls.PAGE_DEFAULT if data['limit'] is None else min(data['limit'], cls.PAGE_MAX)
+        if limit < 1:
+            return {'message': 'Limit must be a positive number.'}, 400
+
+        since = None
+        if data['since']:
+            try:
+                changed_at, user_id = decode_cursor(data['since'], 2)
+                since = parse_datetime(changed_at), user_id
+            except ValueError:
+                return {'message': 'Invalid cursor.'}, 400
+
+        until = datetime.now() - timedelta(seconds=current_app.config.get('CHANGES_SETTLE_SECONDS', 0))
+        upserts = UserModel.find_changed(limit, since, until)
+        deletes = UserTombstone.find_page(limit, since, until)
+
+        changes = sorted(
+            [(row.updated_at, row.id, row) for row in upserts] +
+            [(row.deleted_at, row.user_id, None) for row in deletes],
+            key=lambda change: change[:2],
+        )[:limit]
 
         return {
             'message': 'Success.',
-            'content': users,
+            'content': {
+                'changes': [cls.describe(user_id, row, since) for _, user_id, row in changes],
+                'next': encode_cursor(*changes[-1][:2]) if changes else data['since'],
+                'more': len(upserts) + len(deletes) >= limit,
+            },
+        }
+
+    @staticmethod
+    def describe(user_id, row, since):
+        if row is None:
+            return {'op': 'delete', 'id': user_id}
+        inserted = since is None or row.registration_date > since[0]
+        return {'op': 'insert' if inserted else 'update', 'id': user_id, 'user': UserModel.serialize(row)}
+
+
+class UserSearch(Resource):
+    PAGE_MAX = 1000
+    PAGE_DEFAULT = 50
+    MIN_SUBSTRING = 3
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('q', type=str, location='args')
+    parser.add_argument('field', type=str, location='args', default='username', choices=tuple(UserModel.SEARCH_FIELDS),
+                        help="Field must be one of 'username', 'email' or 'any'.")
+    parser.add_argument('match', type=str, location='args', default='prefix', choices=('prefix', 'contains'),
+                        help="Match must be either 'prefix' or 'contains'.")
+    parser.add_argument('domain', type=str, location='args')
+    parser.add_argument('language', type=str, location='args')
+    parser.add_argument('role_id', type=int, location='args')
+    parser.add_argument('registered_after', type=inputs.datetime_from_iso8601, location='args')
+    parser.add_argument('registered_before', type=inputs.datetime_from_iso8601, location='args')
+    parser.add_argument('limit', type=int, location='args')
+    parser.add_argument('after', type=str, location='args')
+
+    @classmethod
+    @login_required
+    def get(cls):
+        data = UserSearch.parser.parse_args()
+        is_admin = User.get_claims() == 'ADMIN'
+
+        if not is_admin and (data['field'] != 'username' or data['domain']):
+            return {
+                'message': 'Admin privileges required.'
+            }, 401
+        if data['match'] == 'contains' and len(data['q'] or '') < cls.MIN_SUBSTRING:
+            return {'message': f'Substring search needs at least {cls.MIN_SUBSTRING} characters.'}, 400
+
+        limit = cls.PAGE_DEFAULT if data['limit'] is None else min(data['limit'], cls.PAGE_MAX)
+        if limit < 1:
+            return {'message': 'Limit must be a positive number.'}, 400
+
+        after = None
+        if data['after']:
+            try:
+                registration_date, user_id = decode_cursor(data['after'], 2)
+                after = parse_datetime(registration_date), user_id
+            except ValueError:
+                return {'message': 'Invalid cursor.'}, 400
+
+        criteria = UserModel.search_criteria(
+            data['q'], data['field'], data['match'], data['domain'], data['language'], data['role_id'],
+            data['registered_after'], data['registered_before'],
+        )
+        rows = UserModel.find_page(limit, after, UserModel.PUBLIC_FIELDS if is_admin else ('username',), criteria)
+
+        return {
+            'message': 'Success.' if is_admin else UserList.NON_ADMIN_MESSAGE,
+            'content': [UserModel.serialize(row) if is_admin else row.username for row in rows],
+            'next': encode_cursor(rows[-1].registration_date, rows[-1].id) if len(rows) == limit else None,
         }
 
 
@@ -173,10 +413,12 @@ class UserLogin(Resource):
 
         user = UserModel.find_by_username(data['username'])
 
-        if user and check_password_hash(user.password, data['password']):
-            user_role = Role.find_by_id(user.role_id).name
+        if user and hasher.check(user.password, data['password']):
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.hash(data['password'])
+                user.save_to_db()
             content = user.json()
-            token = requests.get(f'{os.environ["TOKEN_SERVICE"]}/token?user_id={user.id}&role={user_role}').json()
+            token = token_service.get('/token', params={'user_id': user.id, 'role': user.role.name}).json()
             session['access_token'] = token['access_token']
             content.update(token)
             return {
@@ -193,8 +435,8 @@ class UserLogout(Resource):
     @classmethod
     @login_required
     def get(cls):
-        resp = requests.get(
-            f'{os.environ["TOKEN_SERVICE"]}/blacklist',
+        resp = token_service.get(
+            '/blacklist',
             headers={
                 'Authorization': f'Bearer {session["access_token"]}'
             }
@@ -203,6 +445,7 @@ class UserLogout(Resource):
             return {
                 'message': 'Something went wrong, try again.'
             }, 503
+        get_verifier().revoke(session['access_token'])
         session.clear()
         return {
             'message': 'Logged out.'
@@ -227,22 +470,85 @@ class UserRegister(Resource):
             return {'message': 'Password cannot be blank.'}, 400
         if data['password1'] != data['password2']:
             return {'message': 'Passwords do not match.'}, 400
-        elif not re.fullmatch(r'[^@\s\'\"]{1,64}@[a-z0-9\-]*\.[a-z0-9]*', data['email']):
+        elif not EMAIL_RE.fullmatch(data['email']):
             return {'message': 'Invalid email address.'}, 400
-        elif UserModel.find_by_email(data['email']):
-            return {'message': 'User already registered with this email.'}, 400
-        elif UserModel.find_by_username(data['username']):
-            return {'message': 'Username taken.'}, 400
 
-        user = UserModel(data['username'], data['password1'], data['email'], data['lang'])
-        user.save_to_db()
+        profile, conflict = UserModel.register(data['username'], data['password1'], data['email'], data['lang'])
+        if conflict:
+            return {'message': CONFLICT_MESSAGES[conflict]}, 400
+        taken_names.add(username=data['username'], email=data['email'])
 
         return {
             'message': 'User successfully created. Log in to continue.',
-            'content': user.json(),
+            'content': profile,
         }, 201
 
 
+class UserAvailability(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('username', type=str, location='args')
+    parser.add_argument('email', type=str, location='args')
+
+    @classmethod
+    def get(cls):
+        data = UserAvailability.parser.parse_args()
+        names = {kind: data[kind] for kind in ('username', 'email') if data[kind]}
+        if not names:
+            return {'message': 'Provide a username or an email to check.'}, 400
+
+        taken_names.start(current_app._get_current_object())
+        # only names the filter can't rule out are looked up
+        maybe_taken = {kind: name for kind, name in names.items() if taken_names.might_be_taken(kind, name)}
+        taken = UserModel.find_taken(**maybe_taken) if maybe_taken else set()
+
+        return {
+            'message': 'Success.',
+            'content': {kind: kind not in taken for kind in names},
+        }
+
+
+def remember_created(users, errors):
+    """ Adds the names of the users bulk_create created, all rows but the failed ones, to the taken names """
+    failed = {error['index'] for error in errors}
+    for index, user in enumerate(users):
+        if index not in failed:
+            taken_names.add(username=user['username'], email=user['email'])
+
+
+class UserBulk(Resource):
+    MAX_USERS = 10000
+
+    parser = reqparse.RequestParser()
+    # rows are passed on as they are, bulk_create validates them and reports failures per row
+    parser.add_argument('users', type=lambda user: user, action='append', location='json', required=True,
+                        help="Please provide a list of users.")
+
+    @classmethod
+    @login_required
+    def post(cls):
+        if User.get_claims() != 'ADMIN':
+            return {
+                'message': 'Admin privileges required.'
+            }, 401
+
+        data = UserBulk.parser.parse_args()
+        if len(data['users']) > cls.MAX_USERS:
+            return {
+                'message': f'At most {cls.MAX_USERS} users can be created at once.'
+            }, 400
+
+        created, errors = UserModel.bulk_create(data['users'])
+        remember_created(data['users'], errors)
+
+        return {
+            'message': f'Created {len(created)} users, {len(errors)} failed.',
+            'content': {
+                'created': created,
+                'errors': errors,
+            },
+        }, 201 if created else 400
+
+
 class GenerateUsers(Resource):
     """ This endpoint is only for development and should be deleted before production """
     @classmethod
@@ -262,8 +568,8 @@ class GenerateUsers(Resource):
                     'email': ''.join(random.choice(ALPHABET) for _ in range(10)) + '@test.com'
                 } for __ in range(100)]
 
-        for user in users:
-            UserModel(**user).save_to_db()
+        _, errors = UserModel.bulk_create(users)
+        remember_created(users, errors)
 
         return {
             'message': 'Succesfully generated 100 random test users.'
@@ -272,6 +578,10 @@ class GenerateUsers(Resource):
 
 class PurgeTestUsers(Resource):
     """ This endpoint is only for development and should be deleted before production """
+    parser = reqparse.RequestParser()
+    parser.add_argument('dry_run', type=inputs.boolean, location='args', default=False)
+    parser.add_argument('chunk_size', type=inputs.positive, location='args', default=1000)
+
     @classmethod
     @login_required
     def delete(cls):
@@ -280,11 +590,22 @@ class PurgeTestUsers(Resource):
                 'message': 'Admin privileges required.'
             }, 401
 
-        test_users = UserModel.query.filter(UserModel.email.endswith('@test.com')).all()
+        data = PurgeTestUsers.parser.parse_args()
+        criterion = UserModel.email_domain == 'test.com'
+        total = UserModel.count_where(criterion)
+
+        if data['dry_run']:
+            return {
+                'message': f'{total} test users would be purged.',
+                'content': {'matched': total},
+            }
 
-        for user in test_users:
-            user.delete_from_db()
+        deleted = 0
+        for rows in UserModel.delete_where(criterion, chunk_size=data['chunk_size']):
+            deleted += len(rows)
+            current_app.logger.info('Purged %d/%d test users', deleted, total)
 
         return {
             'message': 'Test users purged successfully',
-        }
\ No newline at end of file
+            'content': {'deleted': deleted},
+        }
@@ -1,45 +1,47 @@
 import os
 import sys
 
-from sqlalchemy import exc
-from flask_session import Session
+from app import create_app
 
-from app import app
-from db import db
 
+def app_config():
+    """ Config of the app served in production, which init-db has to migrate too """
+    return os.environ.get('APP_CONFIG', 'config.ProductionConfig')
 
-@app.before_first_request
-def create_tables():
-    db.create_all()
 
-    try:
-        from models.role import Role
-        from models.user import UserModel
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'default'
 
-        Role('ADMIN').save_to_db()
-        Role('USER').save_to_db()
-        UserModel('admin', 'admin', 'admin@admin.com', role_id=1, user_id='0').save_to_db()
-    except exc.IntegrityError:
-        db.session.rollback()
+    if command == 'init-db':
+        from bootstrap import init_db
 
+        with create_app(app_config()).app_context():
+            init_db()
+    elif command == 'serve':
+        from serve import serve
 
-if __name__ == '__main__':
-    app.config.from_object('config.DevelopmentConfig')
-    Session(app)
-    db.init_app(app)
+        # every gunicorn worker builds and warms up its own app, see serve.ProductionServer
+        serve(app_config())
+    elif command == 'asgi':
+        from asgi import serve
 
+        # every uvicorn worker builds its own app, see asgi.main
+        serve()
+    elif command in ('docker', 'default'):
+        from bootstrap import init_db
 
-    if len(sys.argv) > 1:
-        if sys.argv[1] == 'docker':
-            app.run(debug=True, host="0.0.0.0")
-        elif sys.argv[1] == 'default':
+        if command == 'default':
             os.environ['FLASK_ENV'] = 'development'
             os.environ['TOKEN_SERVICE'] = 'http://127.0.0.1:5001'
-            app.run(debug=True)
+
+        app = create_app()
+        with app.app_context():
+            init_db()
+
+        if command == 'docker':
+            app.run(debug=True, host="0.0.0.0")
         else:
-            print('Unknown command: {}'.format(sys.argv[1]))
-            sys.exit()
+            app.run(debug=True)
     else:
-        os.environ['FLASK_ENV'] = 'development'
-        os.environ['TOKEN_SERVICE'] = 'http://127.0.0.1:5001'
-        app.run(debug=True)
\ No newline at end of file
+        print('Unknown command: {}'.format(command))
+        sys.exit()
@@ -0,0 +1,74 @@
+"""
+Production server: the app under gunicorn with preforked, threaded workers.
+
+Tuned through environment variables:
+    BIND                    address to listen on (0.0.0.0:5000)
+    WEB_WORKERS             worker processes (2 * CPU cores + 1)
+    WEB_THREADS             threads per worker (4)
+    WEB_MAX_REQUESTS        requests after which a worker is recycled, 0 disables (10000)
+    WEB_MAX_REQUESTS_JITTER random extra requests, so workers don't recycle together (1000)
+    WEB_KEEPALIVE           seconds to keep idle client connections open (5)
+    WEB_TIMEOUT             seconds a silent worker gets before it's killed (30)
+    WEB_GRACEFUL_TIMEOUT    seconds workers get to finish requests on reload or shutdown (30)
+    WARM_UP                 open pool connections and fill caches before a worker takes traffic (1)
+    METRICS_DIR             directory through which workers share their metrics (see metrics.py)
+
+Every worker builds its own app after the fork, so nothing pooled is shared between workers, and
+sending SIGHUP to the master process gracefully replaces the workers with ones running the code
+now on disk. The master's own modules (run.py, app.py, serve.py, metrics.py) are kept by new
+workers; deploying changes to those takes a restart or a USR2 upgrade: send USR2 to start a new
+master next to the old one, then WINCH and QUIT to the old one once the new workers are up.
+"""
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from metrics import shared_metrics
+
+
+def post_worker_init(worker):
+    if os.environ.get('WARM_UP', '1') == '1':
+        from bootstrap import warm_up
+
+        warm_up(worker.wsgi)
+
+
+def options():
+    return {
+        'bind': os.environ.get('BIND', '0.0.0.0:5000'),
+        'workers': int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1)),
+        'threads': int(os.environ.get('WEB_THREADS', 4)),
+        'worker_class': 'gthread',
+        'max_requests': int(os.environ.get('WEB_MAX_REQUESTS', 10000)),
+        'max_requests_jitter': int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 1000)),
+        'keepalive': int(os.environ.get('WEB_KEEPALIVE', 5)),
+        'timeout': int(os.environ.get('WEB_TIMEOUT', 30)),
+        'graceful_timeout': int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30)),
+        'post_worker_init': post_worker_init,
+    }
+
+
+class ProductionServer(BaseApplication):
+    """ Gunicorn running the app built from `config` in each worker """
+    def __init__(self, config, settings=None):
+        self.config = config
+        self.settings = settings or options()
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.settings.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import create_app
+
+        return create_app(self.config)
+
+
+def serve(config):
+    shared_metrics.reset()
+    server = ProductionServer(config)
+    # sizes the hashing pool of each worker, see hashing.PasswordHasher
+    os.environ['WEB_WORKERS'] = str(server.settings['workers'])
+    server.run()
@@ -0,0 +1,237 @@
+"""
+Server-side sessions.
+
+SESSION_TYPE selects where they are kept:
+    memory      an LRU of SESSION_MEMORY_SIZE sessions in each process. The fastest, but sessions
+                are neither shared between worker processes nor kept across restarts.
+    database    a table in SESSION_DATABASE_URI (the app's database by default), shared by all
+                workers. The table is created by init-db, which also switches SQLite databases to
+                WAL mode, so reads don't wait for writes.
+Any other type (e.g. 'filesystem' or 'redis') is handed over to Flask-Session.
+
+Sessions expire PERMANENT_SESSION_LIFETIME after they were last saved. A session is only read
+from the store when a request first uses it, so endpoints which don't, like GET /user/<id>, cost
+no lookup. An unchanged session is only saved again once half of its lifetime has passed, so most
+requests using it only read it. Expired
+rows of the database store are deleted in batches of SESSION_SWEEP_BATCH by a background thread
+every SESSION_SWEEP_INTERVAL seconds.
+"""
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import create_engine, select, Column, DateTime, MetaData, String, Table, Text
+from werkzeug.datastructures import CallbackDict
+
+from cache import TTLCache
+from db import db
+from process_local import PerProcess
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', 60))
+SWEEP_BATCH = int(os.environ.get('SESSION_SWEEP_BATCH', 1000))
+
+
+class StoredSession(CallbackDict, SessionMixin):
+    """ Session whose data is fetched by `load` (returning the stored (data, expires) or None) on first use """
+    # every session expires, without keeping a '_permanent' key in its data
+    permanent = True
+
+    def __init__(self, initial=None, sid=None, expires=None, load=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.expires = expires
+        self.new = expires is None and load is None
+        self.modified = False
+        self._load = load
+
+    @property
+    def loaded(self):
+        return self._load is None
+
+    def _ensure_loaded(self):
+        if self._load is None:
+            return
+        load, self._load = self._load, None
+        stored = load()
+        if stored:
+            data, self.expires = stored
+            dict.update(self, data)
+        else:
+            # expired or unknown, the client gets a new session
+            self.sid = secrets.token_urlsafe(32)
+            self.new = True
+
+
+def _loading(method):
+    def wrapper(self, *args, **kwargs):
+        self._ensure_loaded()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__', '__eq__',
+              '__repr__', 'get', 'keys', 'values', 'items', 'copy', 'setdefault', 'pop', 'popitem', 'update',
+              'clear'):
+    setattr(StoredSession, _name, _loading(getattr(CallbackDict, _name)))
+
+
+class MemoryStore:
+    def __init__(self, maxsize):
+        self.cache = TTLCache(maxsize)
+
+    def get(self, sid):
+        return self.cache.get(sid)
+
+    def set(self, sid, data, expires):
+        self.cache.set(sid, (data, expires), ttl=(expires - datetime.utcnow()).total_seconds())
+
+    def delete(self, sid):
+        self.cache.pop(sid)
+
+
+class DatabaseStore:
+    """ Sessions in a table with an indexed expiry; uses the app's engine unless given a database """
+    table = Table(
+        'sessions', MetaData(),
+        Column('id', String(64), primary_key=True),
+        Column('data', Text, nullable=False),
+        Column('expires_at', DateTime, nullable=False, index=True),
+    )
+
+    def __init__(self, app, uri=None):
+        self.app = app
+        self.uri = uri
+        # engines, and the sweeper thread, are per process
+        self._engine = PerProcess(self._create_engine)
+
+    @property
+    def engine(self):
+        return self._engine.get()
+
+    def _create_engine(self):
+        engine = create_engine(self.uri) if self.uri else db.get_engine(self.app)
+        threading.Thread(target=self._sweep_loop, name='session-sweep', daemon=True).start()
+        return engine
+
+    def create_table(self):
+        """ Creates the sessions table if it's missing; run by init-db, as the table isn't in the app's metadata """
+        engine = create_engine(self.uri) if self.uri else db.get_engine(self.app)
+        try:
+            with engine.begin() as connection:
+                if engine.dialect.name == 'sqlite':
+                    connection.exec_driver_sql('PRAGMA journal_mode=WAL')
+                self.table.create(connection, checkfirst=True)
+        finally:
+            if self.uri:
+                engine.dispose()
+
+    def get(self, sid):
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select([self.table.c.data, self.table.c.expires_at])
+                .where(self.table.c.id == sid)
+                .where(self.table.c.expires_at > datetime.utcnow())
+            ).first()
+
+    def set(self, sid, data, expires):
+        with self.engine.begin() as connection:
+            updated = connection.execute(
+                self.table.update().where(self.table.c.id == sid).values(data=data, expires_at=expires)
+            ).rowcount
+            if not updated:
+                connection.execute(self.table.insert().values(id=sid, data=data, expires_at=expires))
+
+    def delete(self, sid):
+        with self.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.id == sid))
+
+    def sweep(self, batch_size=SWEEP_BATCH):
+        """ Deletes expired sessions `batch_size` rows at a time, returns how many were deleted """
+        deleted = 0
+        while True:
+            expired = select([self.table.c.id])\
+                .where(self.table.c.expires_at <= datetime.utcnow())\
+                .limit(batch_size)
+            with self.engine.begin() as connection:
+                count = connection.execute(self.table.delete().where(self.table.c.id.in_(expired))).rowcount
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Failed to sweep expired sessions')
+
+
+class StoreSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            return StoredSession(sid=sid, load=lambda: self.load(sid))
+        return StoredSession()
+
+    def load(self, sid):
+        stored = self.store.get(sid)
+        if stored:
+            data, expires = stored
+            return self.serializer.loads(data), expires
+        return None
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            # the request didn't use the session, it's left as it is
+            return
+
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                if not session.new:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime
+        if not session.modified and session.expires - now > lifetime / 2:
+            return
+
+        expires = now + lifetime
+        self.store.set(session.sid, self.serializer.dumps(dict(session)), expires)
+        response.set_cookie(
+            name, session.sid, expires=expires, httponly=self.get_cookie_httponly(app), domain=domain,
+            path=path, secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app),
+        )
+
+
+def init_app(app):
+    session_type = app.config.get('SESSION_TYPE')
+    if session_type == 'memory':
+        app.session_interface = StoreSessionInterface(MemoryStore(app.config.get('SESSION_MEMORY_SIZE', 10000)))
+    elif session_type == 'database':
+        app.session_interface = StoreSessionInterface(DatabaseStore(app, app.config.get('SESSION_DATABASE_URI')))
+    else:
+        from flask_session import Session
+
+        Session(app)
@@ -0,0 +1,108 @@
+import json
+import time
+
+import pytest
+from sqlalchemy import event
+from starlette.applications import Starlette
+from starlette.testclient import TestClient
+
+import tokens
+from app import create_app
+from asgi import AsyncServer
+from bench.stubs import SECRET_KEY
+from tokens import TokenVerifier
+
+from .utils import register, login, logout
+
+@pytest.fixture(params=['token service', 'local verification'])
+def servers(client, request, monkeypatch):
+    """ The Flask testing client and a client of the ASGI app with its server, over the same database """
+    monkeypatch.delenv('JWT_JWKS_URL', raising=False)
+    if request.param == 'local verification':
+        monkeypatch.setenv('JWT_SECRET_KEY', SECRET_KEY)
+    else:
+        monkeypatch.delenv('JWT_SECRET_KEY', raising=False)
+    monkeypatch.setattr(tokens, '_verifier', TokenVerifier())
+    monkeypatch.setenv('WARM_UP', '0')
+
+    server = AsyncServer(create_app('config.TestingConfig'))
+    with TestClient(Starlette(routes=server.routes(), lifespan=server.lifespan)) as asgi_client:
+        yield client, asgi_client, server
+
+def compare(flask_client, asgi_client, method, path, **kwargs):
+    """ Sends the same request to both apps and checks they answer alike, returns the body """
+    flask_resp = getattr(flask_client, method)(path, **kwargs)
+    asgi_resp = getattr(asgi_client, method)(path, **kwargs)
+    body = json.loads(flask_resp.get_data(as_text=True))
+
+    assert asgi_resp.status_code == flask_resp.status_code, f"Should answer {method.upper()} {path} alike"
+    assert asgi_resp.json() == body, f"Should answer {method.upper()} {path} alike"
+    assert asgi_resp.headers.get('etag') == flask_resp.headers.get('ETag'), f"Should tag {path} alike"
+    return body
+
+def test_native_endpoints(servers):
+    """ Tests that the native endpoints answer like the Flask app for admins and other users """
+    flask_client, asgi_client, _ = servers
+    register(flask_client, 'asgi', 'asgi', 'asgi@test.com')
+    register(flask_client, 'asgi2', 'asgi2', 'asgi2@test.com')
+
+    for username, password in (('admin', 'admin'), ('asgi', 'asgi')):
+        login(flask_client, username, password)
+        asgi_client.post('/login', data={'username': username, 'password': password})
+
+        compare(flask_client, asgi_client, 'get', '/me')
+        compare(flask_client, asgi_client, 'get', '/user/0')
+        compare(flask_client, asgi_client, 'get', '/user/missing')
+        compare(flask_client, asgi_client, 'get', '/users')
+        page = compare(flask_client, asgi_client, 'get', '/users?limit=1')
+        compare(flask_client, asgi_client, 'get', f'/users?limit=1&after={page["next"]}')
+        compare(flask_client, asgi_client, 'get', '/users?limit=0')
+        compare(flask_client, asgi_client, 'get', '/users?after=garbage')
+        compare(flask_client, asgi_client, 'post', '/users/batch', json={'ids': ['0', 'missing']})
+        compare(flask_client, asgi_client, 'post', '/users/batch', json={'ids': ['0'], 'fields': ['username']})
+        compare(flask_client, asgi_client, 'post', '/users/batch', json={'ids': ['0'], 'fields': ['password']})
+
+        logout(flask_client)
+        asgi_client.get('/logout')
+
+    compare(flask_client, asgi_client, 'get', '/users')
+
+def test_listing_for_users(servers):
+    """ Tests that only the usernames are read when listing users for a non-admin """
+    flask_client, asgi_client, server = servers
+    register(flask_client, 'lister', 'lister', 'lister@test.com')
+    asgi_client.post('/login', data={'username': 'lister', 'password': 'lister'})
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(server.engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        asgi_client.get('/users')
+        asgi_client.get('/users?limit=1')
+    finally:
+        event.remove(server.engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+
+    listings = [statement for statement in statements if 'FROM users' in statement and 'username' in statement]
+
+    assert len(listings) == 2, "Should list the users natively"
+    assert not any('email' in statement for statement in listings), "Should not read fields the caller can't see"
+
+    asgi_client.get('/logout')
+
+def test_revocations_without_warm_up(servers):
+    """ Tests that a worker which didn't warm up still learns about tokens revoked by other processes """
+    flask_client, asgi_client, server = servers
+    if not tokens.get_verifier().enabled:
+        pytest.skip('tokens are checked by the token service')
+    asgi_client.post('/login', data={'username': 'admin', 'password': 'admin'})
+    sid = asgi_client.cookies[server.app.config['SESSION_COOKIE_NAME']]
+    data, _ = server.app.session_interface.load(sid)
+
+    TokenVerifier().revoke(data['access_token'])  # logging out in another process
+    deadline = time.monotonic() + 5
+    while asgi_client.get('/me').status_code == 200 and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    assert asgi_client.get('/me').status_code == 400, "Should reject the token once revocations are synced"
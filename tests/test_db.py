@@ -0,0 +1,96 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+
+import db as db_module
+from db import RoutingSQLAlchemy
+
+routing_db = RoutingSQLAlchemy()
+
+
+class Item(routing_db.Model):
+    __tablename__ = 'items'
+
+    id = routing_db.Column(routing_db.Integer, primary_key=True)
+    name = routing_db.Column(routing_db.String(20), nullable=False)
+
+
+def names():
+    return sorted(row.name for row in routing_db.session.query(Item.name))
+
+@pytest.fixture
+def app(tmp_path):
+    """ App with a primary and a replica SQLite database, which start out with different rows """
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY='test',
+        SQLALCHEMY_DATABASE_URI=f'sqlite:///{tmp_path / "primary.db"}',
+        SQLALCHEMY_BINDS={'replica_0': f'sqlite:///{tmp_path / "replica.db"}'},
+        SQLALCHEMY_REPLICA_BINDS=['replica_0'],
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        REPLICA_STICKY_SECONDS=5,
+    )
+    routing_db.init_app(app)
+
+    @app.route('/items', methods=['GET'])
+    def read():
+        return {'names': names()}
+
+    @app.route('/items', methods=['POST'])
+    def write():
+        routing_db.session.add(Item(name='written'))
+        routing_db.session.commit()
+        return {}
+
+    with app.app_context():
+        for bind in (None, 'replica_0'):
+            engine = routing_db.get_engine(app, bind)
+            Item.__table__.create(engine)
+            engine.execute(Item.__table__.insert(), {'name': 'replica' if bind else 'primary'})
+    return app
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Wall clock of the db module which only moves when the test says so """
+    clock = SimpleNamespace(now=time.time())
+    monkeypatch.setattr(db_module, 'time', SimpleNamespace(time=lambda: clock.now, perf_counter=time.perf_counter))
+    return clock
+
+def test_routing_reads_and_writes(app, clock):
+    """ Tests that reads go to the replica while writes, and reads after them, go to the primary """
+    with app.app_context():
+        assert names() == ['replica'], "Should read from the replica"
+        assert routing_db.session.query(Item.name).with_for_update().all() == [('primary',)], \
+            "Should take locks on the primary"
+
+        routing_db.session.add(Item(name='written'))
+        routing_db.session.flush()
+
+        assert names() == ['primary', 'written'], "Should read its own writes within the transaction"
+
+        routing_db.session.commit()
+
+        assert names() == ['primary', 'written'], "Should keep reading from the primary right after a write"
+
+        clock.now += 5
+
+        assert names() == ['replica'], "Should go back to the replica once replication caught up"
+
+        routing_db.session.remove()
+
+def test_sticky_reads_across_requests(app, clock):
+    """ Tests that a user's requests after a write read from the primary, other users' from the replica """
+    writer, reader = app.test_client(), app.test_client()
+
+    assert writer.get('/items').get_json()['names'] == ['replica']
+
+    writer.post('/items')
+
+    assert writer.get('/items').get_json()['names'] == ['primary', 'written'], "Should read the user's own writes"
+    assert reader.get('/items').get_json()['names'] == ['replica'], "Should read from the replica for other users"
+
+    clock.now += 5
+
+    assert writer.get('/items').get_json()['names'] == ['replica']
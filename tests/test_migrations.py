@@ -0,0 +1,81 @@
+import pytest
+from sqlalchemy import inspect
+
+from app import create_app
+from bootstrap import init_db
+from db import db
+from models.user import UserModel
+
+from .utils import get_json_content
+
+# the schema the service started out with, and the outbox as it was first added
+LEGACY_SCHEMA = '''
+CREATE TABLE roles (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(10) NOT NULL UNIQUE
+);
+CREATE TABLE users (
+    id VARCHAR(22) PRIMARY KEY,
+    role_id INTEGER NOT NULL REFERENCES roles (id),
+    username VARCHAR(30) NOT NULL UNIQUE,
+    password VARCHAR(100) NOT NULL,
+    registration_date TIMESTAMP,
+    email VARCHAR(100) NOT NULL UNIQUE,
+    language VARCHAR(2) NOT NULL
+);
+CREATE TABLE outbox (
+    id SERIAL PRIMARY KEY,
+    topic VARCHAR(50) NOT NULL,
+    key VARCHAR(50) NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    available_at TIMESTAMP NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error VARCHAR(200)
+);
+CREATE INDEX ix_outbox_available_at_id ON outbox (available_at, id);
+INSERT INTO roles (name) VALUES ('ADMIN'), ('USER');
+INSERT INTO users VALUES ('legacy', 2, 'legacy', 'x', '2019-09-01 12:00:00', 'Legacy@Example.COM', 'EN');
+'''
+
+@pytest.fixture(scope="module")
+def legacy_client():
+    """ Testing client for the app, over a database created by the first version of the service """
+    app = create_app('config.TestingConfig')
+    context = app.app_context()
+    context.push()
+    db.drop_all()
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql(LEGACY_SCHEMA)
+
+    yield app.test_client()
+
+    db.session.remove()
+    db.drop_all()
+    context.pop()
+
+def test_migrating_legacy_database(legacy_client):
+    """ Tests that init-db brings an existing database up to date, any number of times """
+    init_db()
+    init_db()
+
+    columns = {column['name']: column for column in inspect(db.engine).get_columns('users')}
+
+    assert {'version', 'email_domain', 'updated_at'} <= set(columns), "Should add the new columns"
+    assert columns['password']['type'].length == UserModel.password.type.length, "Should fit current hashes"
+
+    indexes = {row[0] for row in db.session.execute(db.text("SELECT indexname FROM pg_indexes WHERE tablename = 'users'"))}
+
+    assert {index.name for index in UserModel.__table__.indexes} <= indexes, "Should create the new indexes"
+    assert {'ix_users_username_trgm', 'ix_users_email_trgm'} <= indexes
+
+    outbox_indexes = {index['name'] for index in inspect(db.engine).get_indexes('outbox')}
+
+    assert 'failed_at' in {column['name'] for column in inspect(db.engine).get_columns('outbox')}
+    assert outbox_indexes == {'ix_outbox_failed_at_available_at_id'}, "Should replace the outbox index"
+
+    user = get_json_content(legacy_client.get('/user/legacy'))
+
+    assert user['registration_date'] == '2019-09-01 12:00:00', "Existing users should be served"
+    assert UserModel.find_changed(10)[0].updated_at is not None, "Should backfill the change time"
+    assert UserModel.count_where(*UserModel.search_criteria(domain='EXAMPLE.com')) == 1, \
+        "Should backfill the email domain"
@@ -1,4 +1,26 @@
-from .utils import register, login, logout, get_json_content
+import json
+import os
+import subprocess
+from datetime import datetime
+
+from sqlalchemy import create_engine
+
+import metrics
+import outbox
+import tokens
+from app import create_app
+from availability import taken_names
+from bootstrap import init_db, warm_up
+from config import TestingConfig
+from db import db
+from hashing import PasswordHasher
+from models.outbox import OutboxMessage
+from models.role import Role
+from outbox import Dispatcher, dispatcher
+from sessions import DatabaseStore
+from tokens import TokenVerifier
+
+from .utils import register, login, logout, get_json_content, count_queries
 
 def test_get_no_auth(client):
     """ Returns 418 when accessing GET requests while not authenticated. """
@@ -62,6 +84,15 @@ def test_user_handling(client):
 
     assert '400' in resp.status, "Should fail to register with duplicate email address."
 
+    resp = register(client, 'TEST', 'test', 'other@test.com')
+
+    assert json.loads(resp.get_data(as_text=True))['message'] == 'Username taken.', \
+        "Should compare usernames case-insensitively"
+
+    resp = register(client, 'test2', 'test', 'TEST@test.com')
+
+    assert json.loads(resp.get_data(as_text=True))['message'] == 'User already registered with this email.'
+
 def test_searching_for_user_via_id(client):
     """ Tests /user/<id> endpoint """
     resp = client.get('/user/0')
@@ -72,6 +103,23 @@ def test_searching_for_user_via_id(client):
 
     assert '404' in resp.status, "Should fail"
 
+def test_batch_lookup(client):
+    """ Tests resolving many user ids at once with /users/batch """
+    resp = client.post('/users/batch', json={'ids': ['0', 'missing', '0']})
+    data = get_json_content(resp)
+
+    assert resp.status_code == 200
+    assert data['users']['0']['username'] == 'admin', "Should return public profiles keyed by id"
+    assert data['missing'] == ['missing'], "Should list ids of unknown users"
+
+    data = get_json_content(client.post('/users/batch', json={'ids': ['0'], 'fields': ['username']}))
+
+    assert data['users'] == {'0': {'username': 'admin'}}, "Should only return the requested fields"
+
+    resp = client.post('/users/batch', json={'ids': ['0'], 'fields': ['password']})
+
+    assert resp.status_code == 400, "Should only expose public fields"
+
 def test_admin_functionality(client):
     """ Tests if admin user is available in the db and has proper privileges """
     resp = login(client, 'admin', 'admin')
@@ -212,6 +260,117 @@ def test_generating_random_users(client):
 
     logout(client)
 
+def test_bulk_creation(client):
+    """ Tests /users/bulk creating valid rows and reporting the others """
+    login(client, 'admin', 'admin')
+
+    resp = client.post('/users/bulk', json={'users': [
+        {'username': 'bulk1', 'password': 'bulk', 'email': 'bulk1@test.com'},
+        {'username': 'BULK1', 'password': 'bulk', 'email': 'bulk2@test.com'},
+        {'username': 'bulk3', 'password': 'bulk', 'email': 'not-an-email'},
+        {'username': 'bulk4', 'password': 1234, 'email': 'bulk4@test.com'},
+        'bulk5',
+        {'username': 'admin', 'password': 'bulk', 'email': 'bulk6@test.com'},
+        {'username': 'bulk7', 'password': 'bulk', 'email': 'bulk7@test.com', 'role_id': [1]},
+        {'username': 'bulk8', 'password': 'bulk', 'email': 'bulk8@test.com', 'user_id': 'bulk8'},
+        {'username': 'bulk9', 'password': 'bulk', 'email': 'bulk9@test.com', 'user_id': 'bulk8'},
+        {'username': 'bulk10', 'password': 'bulk', 'email': 'bulk10@test.com', 'user_id': '0'},
+    ]})
+    data = get_json_content(resp)
+
+    assert resp.status_code == 201
+    assert data['created'] == [data['created'][0], 'bulk8'], "Should create the valid rows"
+    assert [error['index'] for error in data['errors']] == [1, 2, 3, 4, 5, 6, 8, 9], "Should report every other row"
+    assert data['errors'][1]['message'] == 'Invalid email address.'
+    assert data['errors'][-1]['message'] == 'User id taken.', "Should report ids which are in use"
+
+    logout(client)
+    login(client, 'test', 'test1')
+
+    assert client.post('/users/bulk', json={'users': []}).status_code == 401
+
+    logout(client)
+
+def test_paginating_users(client):
+    """ Tests keyset pagination and streaming of the user list """
+    login(client, 'admin', 'admin')
+
+    users = get_json_content(client.get('/users'))
+    paged, cursor = [], None
+    while True:
+        query = {'limit': 30, 'after': cursor} if cursor else {'limit': 30}
+        resp = client.get('/users', query_string=query)
+
+        assert resp.status_code == 200
+        data = json.loads(resp.get_data(as_text=True))
+        paged += data['content']
+        cursor = data['next']
+        if not cursor:
+            break
+
+    assert sorted(user['id'] for user in paged) == sorted(user['id'] for user in users), \
+        "Pages should cover every user exactly once"
+
+    resp = client.get('/users', query_string={'stream': 'ndjson'})
+
+    assert len(resp.get_data(as_text=True).splitlines()) == len(users), "Should stream one user per line"
+    streamed = get_json_content(client.get('/users', query_string={'stream': 'json'}))
+
+    assert sorted(user['id'] for user in streamed) == sorted(user['id'] for user in users)
+
+    resp = client.get('/users', query_string={'after': 'not-a-cursor'})
+
+    assert resp.status_code == 400, "Should reject malformed cursors"
+    assert client.get('/users?limit=0').status_code == 400, "Should reject a zero limit"
+
+    logout(client)
+
+def test_searching_users(client):
+    """ Tests /users/search filters and pagination """
+    login(client, 'admin', 'admin')
+
+    data = get_json_content(client.get('/users/search', query_string={'q': 'ADM'}))
+
+    assert [user['username'] for user in data] == ['admin'], "Should match username prefixes case-insensitively"
+
+    data = get_json_content(client.get('/users/search', query_string={'q': 'dmi', 'match': 'contains'}))
+
+    assert [user['username'] for user in data] == ['admin'], "Should match substrings"
+
+    data = get_json_content(client.get('/users/search', query_string={'q': 'admin@', 'field': 'any'}))
+
+    assert [user['id'] for user in data] == ['0'], "Should match email prefixes"
+
+    found, cursor = [], None
+    while True:
+        query = {'domain': 'TEST.com', 'limit': 40}
+        resp = client.get('/users/search', query_string=dict(query, after=cursor) if cursor else query)
+        data = json.loads(resp.get_data(as_text=True))
+        found += data['content']
+        cursor = data['next']
+        if not cursor:
+            break
+
+    assert len(found) >= 100 and all(user['email'].endswith('@test.com') for user in found), \
+        "Should page through every user of the domain"
+
+    resp = client.get('/users/search', query_string={'q': 'ad', 'match': 'contains'})
+
+    assert resp.status_code == 400, "Should reject too short substrings"
+    assert client.get('/users/search', query_string={'q': 'adm', 'limit': 0}).status_code == 400, \
+        "Should reject a zero limit"
+    assert not get_json_content(client.get('/users/search', query_string={'language': 'PL', 'role_id': 1}))
+
+    logout(client)
+    login(client, 'test', 'test1')
+
+    resp = client.get('/users/search', query_string={'q': 'adm'})
+
+    assert get_json_content(resp) == ['admin'], "Should provide only usernames to regular users"
+    assert client.get('/users/search', query_string={'domain': 'test.com'}).status_code == 401
+
+    logout(client)
+
 def test_purging_test_users(client):
     login(client, 'admin', 'admin')
 
@@ -224,6 +383,31 @@ def test_purging_test_users(client):
 
     assert len(data) == 1, 'The only user remaining should be admin'
 
+def test_purging_in_chunks(client):
+    """ Tests that a dry run only counts the test users and that purging deletes them chunk by chunk """
+    for i in range(5):
+        register(client, f'purged{i}', 'purged', f'purged{i}@test.com')
+    register(client, 'kept', 'kept', 'kept@kept.com')
+    login(client, 'admin', 'admin')
+
+    resp = client.delete('/purge', query_string={'dry_run': 'true'})
+
+    assert resp.status_code == 200
+    assert get_json_content(resp) == {'matched': 5}, "Should count the test users"
+    assert len(get_json_content(client.get('/users'))) == 7, "Should not delete anything in a dry run"
+
+    with count_queries() as queries:
+        resp = client.delete('/purge', query_string={'chunk_size': 2})
+    deletes = [query for query in queries if query.startswith('DELETE FROM users')]
+
+    assert get_json_content(resp) == {'deleted': 5}
+    assert len(deletes) > 2, "Should delete at most chunk_size users per statement"
+    assert [user['username'] for user in get_json_content(client.get('/users'))] == ['admin', 'kept'], \
+        "Should delete only the test users"
+
+    kept = next(user for user in get_json_content(client.get('/users')) if user['username'] == 'kept')
+    client.delete(f'/user/{kept["id"]}')
+
 def test_deleting_self(client):
     register(client, 'test', 'test', 'test@test.com')
     login(client, 'test', 'test')
@@ -242,3 +426,300 @@ def test_deleting_self(client):
     data = get_json_content(resp)
 
     assert len(data) == 1
+
+    backlog = get_json_content(client.get('/admin/outbox'))['backlog']
+
+    assert backlog > 0, "Scores of deleted users should be queued for deletion"
+    assert dispatcher.dispatch_once() == backlog
+    assert get_json_content(client.get('/admin/outbox'))['backlog'] == 0, "Delivered messages should be removed"
+
+def test_outbox_delivery_attempts(client, monkeypatch):
+    """ Tests that messages are delivered under a committed lease and given up on after OUTBOX_MAX_ATTEMPTS """
+    monkeypatch.setenv('OUTBOX_MAX_ATTEMPTS', '2')
+    monkeypatch.setenv('OUTBOX_BACKOFF', '0')
+    leases = []
+
+    def deliver(keys):
+        # as another dispatcher would see the messages meanwhile; NOWAIT fails if they are still locked
+        with db.engine.connect() as connection:
+            leases.extend(connection.exec_driver_sql(
+                "SELECT available_at FROM outbox WHERE topic = 'test' FOR UPDATE NOWAIT"
+            ).scalars().all())
+        return keys
+
+    test_dispatcher = Dispatcher({'test': deliver})
+    OutboxMessage.add('test', ['a', 'b'])
+    db.session.commit()
+
+    assert test_dispatcher.dispatch_once() == 2
+    assert len(leases) == 2 and all(lease > datetime.now() for lease in leases), \
+        "Should not lock the messages while delivering them, only lease them"
+    assert outbox.backlog()['backlog'] == 2, "Should retry failed deliveries"
+
+    assert test_dispatcher.dispatch_once() == 2
+    stats = outbox.backlog()
+
+    assert (stats['backlog'], stats['failed']) == (0, 2), "Should give up after OUTBOX_MAX_ATTEMPTS"
+    assert test_dispatcher.dispatch_once() == 0, "Should not claim messages it gave up on"
+
+    OutboxMessage.query.filter_by(topic='test').delete()
+    db.session.commit()
+
+def test_pool_stats(client):
+    """ Tests that /admin/pool reports the connection pool to admins only """
+    register(client, 'pooled', 'pooled', 'pooled@pooled.com')
+    login(client, 'pooled', 'pooled')
+
+    assert client.get('/admin/pool').status_code == 401, "Should require admin privileges"
+
+    login(client, 'admin', 'admin')
+    stats = get_json_content(client.get('/admin/pool'))
+
+    assert set(stats) == {'size', 'checked_out', 'idle', 'overflow', 'max_overflow', 'checkouts', 'timeouts',
+                          'avg_wait_ms', 'max_wait_ms'}, "Should report the timed pool's statistics"
+    assert stats['checkouts'] > 0 and stats['timeouts'] == 0
+    assert stats['checked_out'] >= 1, "Should count the connection serving the request"
+    assert stats['max_wait_ms'] >= stats['avg_wait_ms'] >= 0
+
+    pooled = next(user for user in get_json_content(client.get('/users')) if user['username'] == 'pooled')
+    client.delete(f'/user/{pooled["id"]}')
+    logout(client)
+
+def test_login_query_count(client):
+    """ Logging in should take a single query, roles are loaded together with the user """
+    logout(client)
+
+    with count_queries() as queries:
+        resp = login(client, 'admin', 'admin')
+
+    assert resp.status_code == 200
+    assert len(queries) == 1, f"Login should run exactly one query, ran: {queries}"
+
+    logout(client)
+
+def test_conditional_get(client, monkeypatch):
+    """ Tests ETag / If-None-Match handling of user resources """
+    resp = client.get('/user/0')
+    etag = resp.headers['ETag']
+
+    assert resp.status_code == 200 and etag, "Should tag the user resource"
+
+    resp = client.get('/user/0', headers={'If-None-Match': etag})
+
+    assert resp.status_code == 304, "Should not resend an unchanged user"
+
+    login(client, 'admin', 'admin')
+    users_etag = client.get('/users').headers['ETag']
+
+    assert client.get('/users', headers={'If-None-Match': users_etag}).status_code == 304
+
+    client.put('/me', data=dict(language='PL'))
+
+    resp = client.get('/user/0', headers={'If-None-Match': etag})
+
+    assert resp.status_code == 200, "Should resend the user after a change"
+    assert resp.headers['ETag'] != etag
+    assert client.get('/users', headers={'If-None-Match': users_etag}).status_code == 200
+
+    client.put('/me', data=dict(language='EN'))
+    monkeypatch.setitem(client.application.config, 'CHANGES_SETTLE_SECONDS', 60)
+
+    assert 'ETag' not in client.get('/users').headers, "Should not tag the list until recent writes settled"
+
+    logout(client)
+
+def test_profile_cache(client):
+    """ Tests that profiles are served from the cache until the user changes """
+    client.get('/user/0')
+
+    with count_queries() as queries:
+        resp = client.get('/user/0')
+
+    assert resp.status_code == 200 and not queries, f"Should serve a cached profile, ran: {queries}"
+    assert 'user_profile_cache_requests_total{result="hit"}' in client.get('/metrics').get_data(as_text=True)
+
+    login(client, 'admin', 'admin')
+    client.put('/me', data=dict(language='PL'))
+
+    assert get_json_content(client.get('/user/0'))['language'] == 'PL', "Should drop the profile on updates"
+
+    client.put('/me', data=dict(language='EN'))
+    logout(client)
+
+def test_change_feed(client):
+    """ Tests /users/changes reporting inserts, updates and deletions after a cursor """
+    login(client, 'admin', 'admin')
+
+    def changes(since):
+        content = get_json_content(client.get('/users/changes', query_string={'since': since} if since else {}))
+        return content['changes'], content['next']
+
+    history, cursor = changes(None)
+    while True:
+        page, cursor = changes(cursor)
+        if not page:
+            break
+        history += page
+
+    assert {change['op'] for change in history} == {'insert', 'delete'}, "Should report earlier changes"
+
+    register(client, 'feed', 'feed', 'feed@feed.com')
+    (change,), cursor = changes(cursor)
+    user_id = change['id']
+
+    assert change['op'] == 'insert' and change['user']['username'] == 'feed'
+    assert changes(cursor) == ([], cursor), "Should keep the cursor when nothing changed"
+
+    logout(client)
+    login(client, 'feed', 'feed')
+    client.put('/me', data=dict(language='PL'))
+    logout(client)
+    login(client, 'admin', 'admin')
+    (change,), cursor = changes(cursor)
+
+    assert change['op'] == 'update' and change['user']['language'] == 'PL'
+
+    client.delete(f'/user/{user_id}')
+    (change,), cursor = changes(cursor)
+
+    assert change == {'op': 'delete', 'id': user_id}
+    assert client.get('/users/changes', query_string={'limit': 0}).status_code == 400, "Should reject a zero limit"
+
+    logout(client)
+
+def test_availability_check(client):
+    """ Tests /register/available """
+    def available(**names):
+        return get_json_content(client.get('/register/available', query_string=names))
+
+    assert available(username='ADMIN', email='Admin@admin.com') == {'username': False, 'email': False}, \
+        "Should compare names case-insensitively"
+    assert client.get('/register/available').status_code == 400
+
+    taken_names.build()  # normally built in the background
+    with count_queries() as queries:
+        data = available(username='free-name', email='free@name.com')
+
+    assert data == {'username': True, 'email': True}
+    assert not queries, "Should rule out free names without a query"
+
+    register(client, 'available', 'test', 'available@test.com')
+
+    assert available(username='available') == {'username': False}, "Should know about new users right away"
+
+    login(client, 'admin', 'admin')
+    client.post('/users/bulk', json={'users': [
+        {'username': 'bulk-available', 'password': 'test', 'email': 'bulk-available@test.com'},
+        {'username': 'bulk-available', 'password': 'test', 'email': 'not-created@test.com'},
+    ]})
+    logout(client)
+
+    assert available(username='bulk-available', email='bulk-available@test.com') == \
+        {'username': False, 'email': False}, "Should know about users created in bulk right away"
+    assert available(email='not-created@test.com') == {'email': True}, "Should leave out rows which failed"
+
+def test_warm_up_failures(client, monkeypatch):
+    """ Tests that a worker still starts when warming it up fails """
+    def unreachable():
+        raise ConnectionError('database unreachable')
+
+    monkeypatch.setattr(Role, 'names', unreachable)
+    monkeypatch.setattr(tokens, '_verifier', TokenVerifier())
+    monkeypatch.setattr(tokens.get_verifier(), 'jwks_url', 'http://127.0.0.1:9/jwks')
+    monkeypatch.setenv('TOKEN_SERVICE_RETRIES', '0')
+
+    warm_up(client.application)
+
+    assert client.get('/user/0').status_code == 200
+
+def test_password_hashing(monkeypatch):
+    """ Tests bulk hashing and that hashes made with the configured method are kept """
+    monkeypatch.setenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+    monkeypatch.setenv('PASSWORD_HASH_WORKERS', '2')
+    monkeypatch.setenv('PASSWORD_HASH_QUEUE', '2')
+    monkeypatch.setenv('PASSWORD_HASH_CHUNK', '2')
+    hasher = PasswordHasher()
+    passwords = [f'password{i}' for i in range(7)]
+
+    hashes = hasher.hash_many(passwords)
+
+    assert all(hasher.check(*pair) for pair in zip(hashes, passwords)), "Should hash every password in order"
+    assert not hasher.needs_rehash(hashes[0]), "Should account for the default cost"
+    assert hasher.needs_rehash('pbkdf2:sha256:1000$salt$hash')
+    assert hasher._slots.acquire(blocking=False), "Should free the slots of bulk jobs"
+
+def test_hashing_workers_per_web_worker(monkeypatch):
+    """ Tests that the web workers' hashing pools together default to about one process per core """
+    monkeypatch.delenv('PASSWORD_HASH_WORKERS', raising=False)
+    monkeypatch.delenv('PASSWORD_HASH_QUEUE', raising=False)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    monkeypatch.setenv('WEB_WORKERS', '3')
+
+    assert PasswordHasher().workers == 2, "Should share the cores between the web workers"
+
+    monkeypatch.setenv('WEB_WORKERS', '17')
+
+    assert PasswordHasher().workers == 1, "Should keep at least one hashing process"
+
+    monkeypatch.setenv('PASSWORD_HASH_WORKERS', '4')
+
+    assert PasswordHasher().workers == 4
+
+def test_shared_metrics(client, monkeypatch, tmp_path):
+    """ Tests that /metrics adds up the metrics written by all worker processes """
+    shared = metrics.SharedMetrics(str(tmp_path), 60)
+    monkeypatch.setattr(metrics, 'shared_metrics', shared)
+    worker = subprocess.Popen(['true'])
+    worker.wait()
+    (tmp_path / 'recycled-worker.json').write_text(json.dumps({'pid': worker.pid, 'values': {
+        'upstream_rejections_total': [[['token', 'bulkhead'], 3]],
+        'upstream_circuit_state': [[['token'], 2]],
+    }}))
+
+    metrics.upstream_rejections.inc(upstream='token', reason='bulkhead')
+    metrics.upstream_circuit_state.set(0, upstream='probe')
+    own = dict(metrics.upstream_rejections.items())[('token', 'bulkhead')]
+    text = client.get('/metrics').get_data(as_text=True)
+
+    assert f'upstream_rejections_total{{upstream="token",reason="bulkhead"}} {own + 3}' in text, \
+        "Should add up counters of past and present workers"
+    assert f'upstream_circuit_state{{upstream="probe",pid="{os.getpid()}"}} 0' in text, "Should label gauges by worker"
+    assert f'pid="{worker.pid}"' not in text, "Should leave out gauges of workers which are gone"
+    assert len(list(tmp_path.glob('*.json'))) == 2, "Should write the values of this process"
+
+    shared.reset()
+
+    assert not list(tmp_path.iterdir()), "Should forget earlier runs"
+
+def test_lazy_sessions(client, monkeypatch):
+    """ Tests that the session is only read from the store by requests which use it """
+    login(client, 'admin', 'admin')
+    store = client.application.session_interface.store
+    lookups = []
+    get = store.get
+    monkeypatch.setattr(store, 'get', lambda sid: lookups.append(sid) or get(sid))
+
+    assert client.get('/user/0').status_code == 200
+    assert not lookups, "Should not read a session which isn't used"
+
+    assert client.get('/me').status_code == 200
+    assert len(lookups) == 1, "Should read the session once it's used"
+
+    logout(client)
+
+def test_database_sessions(client, tmp_path):
+    """ Tests that init-db creates the table of database sessions, which requests then only read and write """
+    uri = f'sqlite:///{tmp_path / "sessions.db"}'
+    config = type('DatabaseSessions', (TestingConfig,), {'SESSION_TYPE': 'database', 'SESSION_DATABASE_URI': uri})
+    app = create_app(config)
+    with app.app_context():
+        init_db()
+
+    with create_engine(uri).connect() as connection:
+        assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert DatabaseStore.table.exists(connection), "Should create the sessions table"
+
+    sessions_client = app.test_client()
+    login(sessions_client, 'admin', 'admin')
+
+    assert sessions_client.get('/me').status_code == 200, "Should keep the session in the table"
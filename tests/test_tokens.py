@@ -0,0 +1,135 @@
+import base64
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+
+import jwt
+import pytest
+
+import tokens
+from models.revoked_token import RevokedToken
+from tokens import TokenVerifier, InvalidToken
+from upstream import UpstreamUnavailable
+
+from .utils import get_json_content
+
+SECRET = 'secret-key-for-the-token-tests-only'
+
+def make_verifier(monkeypatch, **env):
+    """ Fresh verifier configured by `env`, also used by login_required """
+    for name in ('JWT_SECRET_KEY', 'JWT_JWKS_URL'):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    verifier = TokenVerifier()
+    monkeypatch.setattr(tokens, '_verifier', verifier)
+    return verifier
+
+def make_token(user_id='0', role='ADMIN', expires_in=900, secret=SECRET):
+    now = int(time.time())
+    return jwt.encode({
+        'identity': user_id,
+        'user_claims': {'role': role},
+        'jti': str(uuid.uuid4()),
+        'iat': now,
+        'exp': now + expires_in,
+    }, secret, algorithm='HS256')
+
+def test_verifying_tokens(monkeypatch):
+    """ Tests local verification of signed access tokens """
+    verifier = make_verifier(monkeypatch, JWT_SECRET_KEY=SECRET)
+
+    claims = verifier.verify(make_token('user-1', 'USER'))
+
+    assert (claims['user_id'], claims['user_role']) == ('user-1', 'USER'), "Should read identity and role"
+
+    with pytest.raises(InvalidToken, match='expired'):
+        verifier.verify(make_token(expires_in=-60))
+    with pytest.raises(InvalidToken):
+        verifier.verify(make_token(secret='another-secret-key-of-the-same-size'))
+    with pytest.raises(InvalidToken, match='Missing claim'):
+        verifier.verify(jwt.encode({'exp': int(time.time()) + 60}, SECRET, algorithm='HS256'))
+
+def test_revoking_tokens(client, monkeypatch):
+    """ Tests that a revocation reaches the other processes through the database """
+    verifier = make_verifier(monkeypatch, JWT_SECRET_KEY=SECRET)
+    other_process = TokenVerifier()
+    token = make_token()
+
+    verifier.revoke(token)
+
+    with pytest.raises(InvalidToken, match='revoked'):
+        verifier.verify(token)
+    assert other_process.verify(token)['user_id'] == '0', "Other processes only learn about it on their next sync"
+
+    other_process.sync_revocations()
+
+    with pytest.raises(InvalidToken, match='revoked'):
+        other_process.verify(token)
+
+def test_syncing_revocations(client, monkeypatch):
+    """ Tests that every revocation is kept, and that syncs only load the new ones """
+    verifier = make_verifier(monkeypatch, JWT_SECRET_KEY=SECRET)
+    monkeypatch.setattr(tokens, 'REVOCATION_SYNC_OVERLAP', timedelta(0))
+    other_process = TokenVerifier()
+    other_process.sync_revocations()
+    tokens_ = [make_token() for _ in range(5)]
+    for token in tokens_:
+        verifier.revoke(token)
+
+    loaded = []
+    find_active = RevokedToken.find_active
+    monkeypatch.setattr(RevokedToken, 'find_active', lambda since=None: loaded.extend(find_active(since)) or loaded)
+    other_process.sync_revocations()
+
+    for token in tokens_:
+        with pytest.raises(InvalidToken, match='revoked'):
+            other_process.verify(token)
+    assert len(loaded) == len(tokens_), "Should only load revocations made since the previous sync"
+
+def test_login_required(client, monkeypatch):
+    """ Tests login_required with locally verified tokens """
+    make_verifier(monkeypatch, JWT_SECRET_KEY=SECRET)
+
+    with client.session_transaction() as session:
+        session['access_token'] = make_token()
+    resp = client.get('/me')
+
+    assert resp.status_code == 200 and get_json_content(resp)['username'] == 'admin'
+
+    with client.session_transaction() as session:
+        session['access_token'] = make_token(expires_in=-60)
+    resp = client.get('/me')
+
+    assert resp.status_code == 400 and resp.get_json()['message'] == 'Invalid token'
+
+def test_unavailable_key_set(client, monkeypatch):
+    """ Tests that a key set which can't be fetched makes login_required answer 503 """
+    make_verifier(monkeypatch, JWT_JWKS_URL='http://127.0.0.1:9/jwks')
+    monkeypatch.setenv('TOKEN_SERVICE_RETRIES', '0')
+
+    with client.session_transaction() as session:
+        session['access_token'] = make_token()
+    resp = client.get('/me')
+
+    assert resp.status_code == 503, "Should ask to retry rather than fail"
+    assert resp.headers['Retry-After']
+
+def test_unusable_keys(monkeypatch):
+    """ Tests that keys which can't be used are skipped rather than failing the whole key set """
+    verifier = make_verifier(monkeypatch, JWT_JWKS_URL='http://127.0.0.1:9/jwks', JWT_ALGORITHMS='HS256')
+    good = {'kty': 'oct', 'kid': 'good', 'k': base64.urlsafe_b64encode(SECRET.encode()).decode().rstrip('=')}
+    key_set = {'keys': [{'kty': 'unknown', 'kid': 'bad'}, good]}
+    monkeypatch.setattr(tokens.token_service, 'get', lambda url: SimpleNamespace(
+        raise_for_status=lambda: None, json=lambda: key_set))
+
+    token = jwt.encode({'identity': '0', 'exp': int(time.time()) + 60}, SECRET, algorithm='HS256',
+                       headers={'kid': 'good'})
+
+    assert verifier.verify(token)['user_id'] == '0', "Should verify with the usable key"
+
+    key_set = {'keys': [{'kty': 'unknown', 'kid': 'bad'}]}
+
+    with pytest.raises(UpstreamUnavailable):
+        verifier.refresh_keys()
@@ -0,0 +1,107 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import upstream
+from upstream import CircuitBreaker, UpstreamClient, UpstreamUnavailable
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Monotonic clock of the upstream module which only moves when the test says so """
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(upstream, 'time', SimpleNamespace(
+        monotonic=lambda: clock.now, perf_counter=time.perf_counter, sleep=time.sleep,
+    ))
+    return clock
+
+def rejections(reason):
+    return dict(upstream.upstream_rejections.items()).get(('test', reason), 0)
+
+def test_circuit_breaker(clock):
+    """ Tests that the breaker opens on failed or slow calls, probes once half-open and closes again """
+    breaker = CircuitBreaker('test', window=10, min_calls=4, error_rate=.5, slow_call=1, slow_rate=.5, open_seconds=5)
+
+    for failed in (True, True, True):
+        assert breaker.allow()
+        breaker.record(0.1, failed)
+    clock.now += 11
+    for failed in (False, False, True, False):
+        assert breaker.allow()
+        breaker.record(0.1, failed)
+
+    assert breaker.state == CircuitBreaker.CLOSED, "Should forget calls which left the window"
+
+    for elapsed in (2, 2, 2, 2):
+        breaker.record(elapsed, False)
+
+    assert breaker.state == CircuitBreaker.OPEN, "Should open when too many calls are slow"
+    assert not breaker.allow(), "Should fail calls fast while open"
+    assert breaker.retry_after() == 5
+
+    clock.now += 5
+
+    assert breaker.allow(), "Should let a probe through once half-open"
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow(), "Should let a single probe through"
+
+    breaker.record(0.1, True)
+
+    assert breaker.state == CircuitBreaker.OPEN, "Should open again when the probe fails"
+    assert not breaker.allow()
+
+    clock.now += 5
+    breaker.allow()
+    breaker.record(2, False)
+
+    assert breaker.state == CircuitBreaker.OPEN, "Should open again when the probe is slow"
+
+    clock.now += 5
+    breaker.allow()
+    breaker.record(0.1, False)
+
+    assert breaker.state == CircuitBreaker.CLOSED, "Should close when the probe succeeds"
+    assert breaker.allow() and breaker.allow(), "Should let every call through once closed"
+
+    for failed in (True, False, True, False):
+        breaker.record(0.1, failed)
+
+    assert breaker.state == CircuitBreaker.OPEN, "Should open when too many calls fail"
+
+def test_bulkhead(clock, monkeypatch):
+    """ Tests that calls beyond MAX_CONCURRENT and calls to an open circuit are refused without being made """
+    monkeypatch.setenv('TEST_SERVICE', 'http://127.0.0.1:9')
+    monkeypatch.setenv('TEST_SERVICE_MAX_CONCURRENT', '1')
+    monkeypatch.setenv('TEST_SERVICE_BULKHEAD_TIMEOUT', '0.01')
+    monkeypatch.setenv('TEST_SERVICE_RETRIES', '0')
+    monkeypatch.setenv('TEST_SERVICE_BREAKER_MIN_CALLS', '1')
+    client = UpstreamClient('test', 'TEST_SERVICE')
+    calls = []
+    monkeypatch.setattr(client.session, 'request', lambda *args, **kwargs: calls.append(args))
+    bulkhead_rejections = rejections('bulkhead')
+
+    client.bulkhead.acquire()  # a call which hangs
+    try:
+        with pytest.raises(UpstreamUnavailable) as e:
+            client.get('/anything')
+    finally:
+        client.bulkhead.release()
+
+    assert e.value.retry_after == 1
+    assert not calls, "Should not make calls beyond MAX_CONCURRENT"
+    assert rejections('bulkhead') == bulkhead_rejections + 1
+
+    def refused(*args, **kwargs):
+        calls.append(args)
+        raise upstream.requests.ConnectionError()
+
+    monkeypatch.setattr(client.session, 'request', refused)
+    circuit_rejections = rejections('circuit_open')
+
+    for _ in range(2):
+        with pytest.raises(UpstreamUnavailable):
+            client.get('/anything')
+
+    assert len(calls) == 1, "Should stop calling once the circuit opens"
+    assert rejections('circuit_open') == circuit_rejections + 1
+    assert client.bulkhead.acquire(blocking=False), "Should free the slot of every call"
@@ -1,4 +1,9 @@
 import json
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from db import db
 
 def get_json_content(response) -> dict:
     """ Returns a dict-translated JSON with content of the response """
@@ -24,3 +29,17 @@ def login(client, user: str, password: str):
 def logout(client):
     """ Function for logging out of the service """
     return client.get('/logout')
+
+@contextmanager
+def count_queries():
+    """ Collects the SQL statements executed inside the block """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
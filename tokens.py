@@ -0,0 +1,248 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import jwt
+import requests
+
+from db import db
+from models.revoked_token import RevokedToken
+from process_local import PerProcess
+from upstream import token_service, UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+# revocations committed late, after a sync had already read past them, are caught by the next one
+REVOCATION_SYNC_OVERLAP = timedelta(seconds=10)
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class Revocations:
+    """ Keys of revoked tokens with the time they expire (UTC). Entries are only dropped once expired. """
+    def __init__(self):
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, expires_at):
+        with self._lock:
+            self._expires[key] = max(expires_at, self._expires.get(key, expires_at))
+
+    def prune(self):
+        now = datetime.utcnow()
+        with self._lock:
+            self._expires = {key: expires_at for key, expires_at in self._expires.items() if expires_at > now}
+
+    def __contains__(self, key):
+        expires_at = self._expires.get(key)
+        return expires_at is not None and expires_at > datetime.utcnow()
+
+    def __len__(self):
+        return len(self._expires)
+
+
+class TokenVerifier:
+    """
+    Verifies access tokens issued by the token service without calling it.
+
+    The signing key is either a shared secret (JWT_SECRET_KEY) or a JWKS key set (JWT_JWKS_URL)
+    which is fetched once and then refreshed in the background. If it can't be fetched, verification
+    fails with a 503 (UpstreamUnavailable) rather than rejecting the token.
+
+    Revoked tokens are rejected until they would have expired anyway. A revocation takes effect
+    in the revoking process right away and is written to the revoked_tokens table. Every process
+    started with `start` loads the revocations made since its previous sync each JWT_REVOCATION_SYNC
+    seconds; until then other processes still accept the token. Expired rows are deleted every
+    JWT_REVOCATION_PURGE seconds.
+    """
+    def __init__(self):
+        self.secret = os.environ.get('JWT_SECRET_KEY')
+        self.jwks_url = os.environ.get('JWT_JWKS_URL')
+        self.algorithms = os.environ.get('JWT_ALGORITHMS', 'HS256' if self.secret else 'RS256').split(',')
+        self.identity_claim = os.environ.get('JWT_IDENTITY_CLAIM', 'identity')
+        self.role_claim = os.environ.get('JWT_ROLE_CLAIM', 'user_claims.role')
+        self.leeway = int(os.environ.get('JWT_LEEWAY', 10))
+        self.refresh_interval = int(os.environ.get('JWT_JWKS_REFRESH', 600))
+        self.revocation_sync_interval = float(os.environ.get('JWT_REVOCATION_SYNC', 2))
+        self.revocation_purge_interval = float(os.environ.get('JWT_REVOCATION_PURGE', 300))
+        # lifetime of the revocation of a token which doesn't expire
+        self.revocation_ttl = int(os.environ.get('JWT_REVOCATION_TTL', 3600))
+        self.revoked = Revocations()
+        self._revocations_synced = None
+        self._revocations_purged = None
+
+        self._keys = {}
+        self._keys_fetched = None
+        self._keys_lock = threading.Lock()
+        self._refresher = PerProcess(self._start_refresher)
+        self._revocation_sync = PerProcess(self._start_revocation_sync)
+
+    @property
+    def enabled(self):
+        return bool(self.secret or self.jwks_url)
+
+    def verify(self, token):
+        """ Returns normalized claims ({'user_id', 'user_role', 'jti', 'exp'}) of a valid token """
+        try:
+            payload = jwt.decode(token, self._signing_key(token), algorithms=self.algorithms,
+                                 leeway=self.leeway, options={'require': ['exp']})
+        except jwt.ExpiredSignatureError:
+            raise InvalidToken('Token has expired')
+        except jwt.PyJWTError as e:
+            raise InvalidToken(str(e))
+
+        if self._revocation_key(token, payload) in self.revoked:
+            raise InvalidToken('Token has been revoked')
+
+        user_id = self._claim(payload, self.identity_claim)
+        if user_id is None:
+            raise InvalidToken(f'Missing claim: {self.identity_claim}')
+
+        return {
+            'user_id': user_id,
+            'user_role': self._claim(payload, self.role_claim),
+            'jti': payload.get('jti'),
+            'exp': payload['exp'],
+        }
+
+    def revoke(self, token):
+        """ Marks the token as revoked for the rest of its lifetime, in every process """
+        if not self.enabled:
+            return
+        try:
+            payload = jwt.decode(token, options={'verify_signature': False})
+        except jwt.PyJWTError:
+            return
+        ttl = payload['exp'] - time.time() + self.leeway if 'exp' in payload else self.revocation_ttl
+        key = self._revocation_key(token, payload)
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+        self.revoked.add(key, expires_at)
+        RevokedToken.add(key, expires_at)
+
+    def sync_revocations(self):
+        """ Loads the tokens revoked since the previous sync, all active ones the first time """
+        started = datetime.utcnow()
+        since = self._revocations_synced and self._revocations_synced - REVOCATION_SYNC_OVERLAP
+        for key, expires_at in RevokedToken.find_active(since):
+            self.revoked.add(key, expires_at)
+        self._revocations_synced = started
+        self.revoked.prune()
+
+        if self._revocations_purged is None or \
+                time.monotonic() - self._revocations_purged >= self.revocation_purge_interval:
+            RevokedToken.delete_expired()
+            self._revocations_purged = time.monotonic()
+
+    def start(self, app):
+        """ Keeps the revocations of this process in sync from a background thread """
+        if self.enabled:
+            self._revocation_sync.get(app)
+
+    def _start_revocation_sync(self, app):
+        thread = threading.Thread(target=self._revocation_sync_loop, args=(app,), name='jwt-revocations',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _revocation_sync_loop(self, app):
+        with app.app_context():
+            while True:
+                try:
+                    self.sync_revocations()
+                except Exception:
+                    logger.exception('Failed to sync revoked tokens')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                time.sleep(self.revocation_sync_interval)
+
+    @staticmethod
+    def _revocation_key(token, payload):
+        return payload.get('jti') or hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def _claim(payload, path):
+        value = payload
+        for part in path.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+        return value
+
+    def prime(self):
+        """ Fetches the key set ahead of the first request, if one is used """
+        if self.jwks_url:
+            self._refresher.get()
+            self.refresh_keys()
+
+    def _signing_key(self, token):
+        if self.secret:
+            return self.secret
+
+        self._refresher.get()
+        kid = jwt.get_unverified_header(token).get('kid')
+        key = self._keys.get(kid)
+        if key is None:
+            # first use or key rotation: fetch again, but not more often than once a minute
+            if self._keys_fetched is None or time.monotonic() - self._keys_fetched > 60:
+                self.refresh_keys()
+            key = self._keys.get(kid)
+        if key is None:
+            raise InvalidToken('Unknown signing key')
+        return key
+
+    def refresh_keys(self):
+        """ Fetches the key set, raises UpstreamUnavailable if that fails or none of its keys can be used """
+        with self._keys_lock:
+            try:
+                resp = token_service.get(self.jwks_url)
+                resp.raise_for_status()
+                jwks = resp.json()
+            except UpstreamUnavailable as e:
+                raise UpstreamUnavailable(token_service.name, retry_after=e.retry_after or 1)
+            except (requests.RequestException, ValueError):
+                raise UpstreamUnavailable(token_service.name, retry_after=1)
+            listed = jwks.get('keys', []) if isinstance(jwks, dict) else []
+            keys = {}
+            for jwk in listed:
+                # one key of an unsupported type (or whose algorithm needs a missing library) mustn't
+                # take the others down with it
+                try:
+                    keys[jwk.get('kid')] = jwt.PyJWK(jwk).key
+                except Exception:
+                    logger.exception('Skipping unusable key of the key set: %r', jwk)
+            if listed and not keys:
+                raise UpstreamUnavailable(token_service.name, retry_after=1)
+            self._keys = keys
+            self._keys_fetched = time.monotonic()
+
+    def _start_refresher(self):
+        thread = threading.Thread(target=self._refresh_loop, name='jwks-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            # whatever happens, keep serving with the previous key set and try again later
+            try:
+                self.refresh_keys()
+            except UpstreamUnavailable:
+                logger.warning('Failed to refresh the key set')
+            except Exception:
+                logger.exception('Failed to refresh the key set')
+
+
+_verifier = None
+
+
+def get_verifier():
+    global _verifier
+    if _verifier is None:
+        _verifier = TokenVerifier()
+    return _verifier
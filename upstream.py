@@ -0,0 +1,227 @@
+import math
+import os
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from errors import RetryLater
+from metrics import upstream_duration, upstream_rejections, upstream_circuit_state
+from process_local import PerProcess
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+RETRY_STATUSES = frozenset((502, 503, 504))
+
+_ProcessState = namedtuple('_ProcessState', 'session breaker bulkhead')
+
+
+class UpstreamUnavailable(RetryLater):
+    def __init__(self, upstream, retry_after=None):
+        super().__init__(f'The {upstream} service is unavailable, please, try again.', retry_after)
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream which keeps failing or answering slowly.
+
+    Outcomes of the calls of the last `window` seconds are kept. Once there are at least `min_calls`
+    of them and the share of failed or of slow calls reaches its threshold, the breaker opens and
+    calls fail fast for `open_seconds`. Then it half-opens and lets a single probe call through:
+    a good answer closes the breaker, a failed or slow one opens it again.
+    """
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half-open', 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, window=10, min_calls=20, error_rate=.5, slow_call=2.0, slow_rate=.5, open_seconds=5):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self._opened_at = 0
+        self._probing = False
+        self._calls = deque()
+        self._failed = 0
+        self._slow = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Whether a call may be made now; every allowed call must be followed by `record` """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, elapsed, failed):
+        now = time.monotonic()
+        slow = elapsed >= self.slow_call
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._reset()
+                    self._set_state(self.CLOSED)
+                return
+            if self.state == self.OPEN:
+                # a call which started before the breaker opened
+                return
+
+            self._calls.append((now, failed, slow))
+            self._failed += failed
+            self._slow += slow
+            while self._calls[0][0] < now - self.window:
+                _, old_failed, old_slow = self._calls.popleft()
+                self._failed -= old_failed
+                self._slow -= old_slow
+
+            total = len(self._calls)
+            if total >= self.min_calls and (self._failed / total >= self.error_rate or
+                                            self._slow / total >= self.slow_rate):
+                self._open(now)
+
+    def retry_after(self):
+        return max(1, math.ceil(self.open_seconds - (time.monotonic() - self._opened_at)))
+
+    def _open(self, now):
+        self._opened_at = now
+        self._reset()
+        self._set_state(self.OPEN)
+
+    def _reset(self):
+        self._calls.clear()
+        self._failed = self._slow = 0
+
+    def _set_state(self, state):
+        self.state = state
+        upstream_circuit_state.set(self.STATE_VALUES[state], upstream=self.name)
+
+
+class UpstreamClient:
+    """
+    HTTP client for one of the Score Builder services.
+
+    Every worker process gets its own keep-alive `requests.Session`, so connections are reused
+    between requests but never shared across a fork. Settings are read from the environment,
+    `<SERVICE>_<SETTING>` taking precedence over `UPSTREAM_<SETTING>`, e.g. TOKEN_SERVICE_READ_TIMEOUT.
+
+    Calls are guarded by a circuit breaker (BREAKER_* settings) and a bulkhead: at most
+    MAX_CONCURRENT calls per process are in flight, further ones wait up to BULKHEAD_TIMEOUT
+    seconds for a slot. Keep MAX_CONCURRENT below the worker's thread count, so a hanging
+    upstream can't tie up every thread. Rejected calls fail fast with a 503.
+    """
+    def __init__(self, name, env_var):
+        self.name = name
+        self.env_var = env_var
+        # connections, locks and call statistics are per process
+        self._state = PerProcess(lambda: _ProcessState(
+            self._create_session(), self._create_breaker(),
+            threading.BoundedSemaphore(self.setting('MAX_CONCURRENT', 8, int)),
+        ))
+
+    def setting(self, key, default, cast=float):
+        return cast(os.environ.get(f'{self.env_var}_{key}', os.environ.get(f'UPSTREAM_{key}', default)))
+
+    @property
+    def base_url(self):
+        return os.environ[self.env_var]
+
+    @property
+    def session(self):
+        return self._state.get().session
+
+    @property
+    def breaker(self):
+        return self._state.get().breaker
+
+    @property
+    def bulkhead(self):
+        return self._state.get().bulkhead
+
+    def _create_breaker(self):
+        return CircuitBreaker(
+            self.name,
+            window=self.setting('BREAKER_WINDOW', 10),
+            min_calls=self.setting('BREAKER_MIN_CALLS', 20, int),
+            error_rate=self.setting('BREAKER_ERROR_RATE', .5),
+            slow_call=self.setting('BREAKER_SLOW_CALL', 2.0),
+            slow_rate=self.setting('BREAKER_SLOW_RATE', .5),
+            open_seconds=self.setting('BREAKER_OPEN_SECONDS', 5),
+        )
+
+    def _create_session(self):
+        pool_size = self.setting('POOL_SIZE', 10, int)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False, max_retries=0)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, path, **kwargs):
+        method = method.upper()
+        url = path if path.startswith(('http://', 'https://')) else f'{self.base_url}{path}'
+        kwargs.setdefault('timeout', (self.setting('CONNECT_TIMEOUT', 1.0), self.setting('READ_TIMEOUT', 5.0)))
+        retries = self.setting('RETRIES', 2, int) if method in IDEMPOTENT_METHODS else 0
+        backoff = self.setting('BACKOFF', 0.1)
+
+        for attempt in range(retries + 1):
+            resp = self._attempt(method, url, kwargs)
+            if resp is None:
+                if attempt == retries:
+                    raise UpstreamUnavailable(self.name)
+            elif resp.status_code not in RETRY_STATUSES or attempt == retries:
+                return resp
+            # exponential backoff with full jitter, so retries from many workers don't line up
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+    def _attempt(self, method, url, kwargs):
+        """ Makes a single call through the bulkhead and the breaker, returns None if it didn't connect """
+        if not self.bulkhead.acquire(timeout=self.setting('BULKHEAD_TIMEOUT', 0.05)):
+            upstream_rejections.inc(upstream=self.name, reason='bulkhead')
+            raise UpstreamUnavailable(self.name, retry_after=1)
+        try:
+            if not self.breaker.allow():
+                upstream_rejections.inc(upstream=self.name, reason='circuit_open')
+                raise UpstreamUnavailable(self.name, retry_after=self.breaker.retry_after())
+
+            resp = None
+            start = time.perf_counter()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+            finally:
+                elapsed = time.perf_counter() - start
+                self.breaker.record(elapsed, resp is None or resp.status_code >= 500)
+                failed = resp is None or resp.status_code in RETRY_STATUSES
+                upstream_duration.observe(elapsed, upstream=self.name, method=method,
+                                          outcome='error' if failed else 'ok')
+            return resp
+        finally:
+            self.bulkhead.release()
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+
+token_service = UpstreamClient('token', 'TOKEN_SERVICE')
+score_service = UpstreamClient('score', 'SCORE_SERVICE')
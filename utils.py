@@ -1,10 +1,72 @@
-from flask import session
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from functools import wraps
+
+from flask import session, g, request, current_app, Response
+from werkzeug.http import quote_etag
+
+from tokens import get_verifier, InvalidToken
+
 
 def login_required(f):
+    @wraps(f)
     def wrapper(*args, **kwargs):
         if 'access_token' not in session:
             return {
                 'message': 'Login required.'
             }, 418
+
+        verifier = get_verifier()
+        if verifier.enabled:
+            verifier.start(current_app._get_current_object())
+            try:
+                g.token_claims = verifier.verify(session['access_token'])
+            except InvalidToken as e:
+                return {
+                    'message': 'Invalid token',
+                    'content': {'msg': str(e)},
+                }, 400
         return f(*args, **kwargs)
     return wrapper
+
+
+def encode_cursor(*values):
+    """ Packs keyset pagination values into an opaque, url-safe cursor """
+    return urlsafe_b64encode('|'.join(str(value) for value in values).encode()).decode()
+
+
+def decode_cursor(cursor, parts):
+    """ Inverse of encode_cursor, raises ValueError on malformed input """
+    try:
+        values = urlsafe_b64decode(cursor.encode()).decode().split('|')
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError('Invalid cursor.')
+    if len(values) != parts:
+        raise ValueError('Invalid cursor.')
+    return values
+
+
+def parse_datetime(value):
+    """ Parses datetimes serialized with str(), with or without microseconds """
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f'Invalid datetime: {value}')
+
+
+def etag_matches(etag):
+    """ Whether the request's If-None-Match header lists the given (unquoted) entity tag, if there is one """
+    return etag is not None and etag in request.if_none_match
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def etag_header(etag):
+    return {'ETag': quote_etag(etag)} if etag else {}